@@ -7,11 +7,16 @@
 import os
 from celery import Celery
 
+from . import serializers
+
 
 class BroccoliPipeline:
+    """Sends scraped items to the worker for import, in batches of IMPORT_BATCH_SIZE."""
 
     def __init__(self):
         self.celery = None
+        self.batch = []
+        self.batch_size = int(os.environ.get('IMPORT_BATCH_SIZE', 100))
 
     def open_spider(self, spider):
         self.celery = Celery(
@@ -19,8 +24,10 @@ class BroccoliPipeline:
             broker=os.environ['REDIS_URL'],
             backend=os.environ['REDIS_URL']
         )
+        serializers.configure(self.celery)
 
     def close_spider(self, spider):
+        self.send_batch()
         self.celery = None
 
     def process_item(self, item, spider):
@@ -28,11 +35,18 @@ class BroccoliPipeline:
         item_data = dict(item)
         item_data.update(vendor=vendor)
 
-        self.celery.send_task(
-            'ops.spiders.clean_and_import',
-            kwargs={'data': item_data}
-        )
+        self.batch.append(item_data)
+        if len(self.batch) >= self.batch_size:
+            self.send_batch()
 
         return item
 
+    def send_batch(self):
+        if not self.batch:
+            return
 
+        self.celery.send_task(
+            'ops.spiders.bulk_clean_and_import',
+            kwargs={'items': self.batch}
+        )
+        self.batch = []
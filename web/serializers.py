@@ -0,0 +1,76 @@
+import os
+import zlib
+import datetime
+import msgpack
+from kombu.serialization import register
+
+
+########################################################################################################################
+
+
+# A compact binary serializer for task messages and results: msgpack, zlib-compressed when the packed payload is
+# larger than compress_min bytes. The first byte of every payload says whether the rest is compressed.
+#
+# The web and spiders services keep their own copy of this module, since each one is built from its own directory.
+# The copies have to stay identical.
+name = 'msgpack-zlib'
+content_type = 'application/x-msgpack-zlib'
+
+compress_min = int(os.environ.get('SERIALIZER_COMPRESS_MIN', 1024))
+
+PLAIN = b'\x00'
+COMPRESSED = b'\x01'
+DATETIME_EXT = 1
+
+
+def _default(obj):
+    """Pack the types msgpack doesn't know about. Datetimes (Celery puts them in result metadata) survive the round
+    trip; anything else is sent as a string, like the json serializer does with UUIDs and Decimals."""
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(DATETIME_EXT, obj.isoformat().encode())
+    elif isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+
+def _ext_hook(code, data):
+    if code == DATETIME_EXT:
+        return datetime.datetime.fromisoformat(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+def dumps(obj):
+    data = msgpack.packb(obj, default=_default, use_bin_type=True)
+    if len(data) > compress_min:
+        return COMPRESSED + zlib.compress(data)
+    return PLAIN + data
+
+
+def loads(data):
+    if isinstance(data, str):
+        data = data.encode('latin-1')
+
+    marker, data = data[:1], data[1:]
+    if marker == COMPRESSED:
+        data = zlib.decompress(data)
+
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False)
+
+
+register(name, dumps, loads, content_type=content_type, content_encoding='binary')
+
+
+########################################################################################################################
+
+
+def configure(app):
+    """Make app send messages and store results with the serializer in the CELERY_SERIALIZER environment variable
+    (msgpack-zlib by default). JSON is still accepted, so messages sent before the switch can be read."""
+    serializer = os.environ.get('CELERY_SERIALIZER', name)
+
+    app.conf.update(
+        task_serializer=serializer,
+        result_serializer=serializer,
+        accept_content=[name, 'json'],
+        result_accept_content=[name, 'json']
+    )
@@ -4,6 +4,8 @@ import logging
 import celery
 from flask import Flask, request, jsonify
 
+import serializers
+
 
 ########################################################################################################################
 
@@ -14,6 +16,7 @@ celery_app = celery.Celery(
     broker=os.environ['REDIS_URL'],
     backend=os.environ['REDIS_URL']
 )
+serializers.configure(celery_app)
 
 # Direct all logging to stdout. It will get picked up by supervisord
 app.logger.addHandler(logging.StreamHandler(sys.stdout))
@@ -0,0 +1,177 @@
+"""Synthetic MWS and Product Advertising API responses for benchmarks. The documents follow the structure (namespaces,
+nesting, and typical field sizes) of the real responses, and can be generated with any number of items."""
+
+
+########################################################################################################################
+
+
+MWS_PRODUCTS_NS = 'http://mws.amazonservices.com/schema/Products/2011-10-01'
+MWS_ATTRIBUTES_NS = 'http://mws.amazonservices.com/schema/Products/2011-10-01/default.xsd'
+PA_NS = 'http://webservices.amazon.com/AWSECommerceService/2011-08-01'
+
+
+def asin(i):
+    return f'B{i:09d}'
+
+
+def _response_metadata():
+    return '<ResponseMetadata><RequestId>7a2f7bbd-2a54-4e0b-a0b5-9c0e3c1f0a11</RequestId></ResponseMetadata>'
+
+
+########################################################################################################################
+
+
+def get_service_status(n=1):
+    return f'<?xml version="1.0"?>' \
+           f'<GetServiceStatusResponse xmlns="{MWS_PRODUCTS_NS}">' \
+           f'<GetServiceStatusResult><Status>GREEN</Status><Timestamp>2017-08-01T12:00:00.000Z</Timestamp>' \
+           f'</GetServiceStatusResult>{_response_metadata()}</GetServiceStatusResponse>'
+
+
+def list_matching_products(n=10):
+    products = ''.join(
+        f'<Product>'
+        f'<Identifiers><MarketplaceASIN><MarketplaceId>ATVPDKIKX0DER</MarketplaceId><ASIN>{asin(i)}</ASIN>'
+        f'</MarketplaceASIN></Identifiers>'
+        f'<AttributeSets><ns2:ItemAttributes xml:lang="en-US">'
+        f'<ns2:Binding>Kitchen</ns2:Binding><ns2:Brand>Brand {i % 7}</ns2:Brand>'
+        + ''.join(f'<ns2:Feature>Feature {j} of product {i}, with a typical amount of marketing text.</ns2:Feature>'
+                  for j in range(5)) +
+        f'<ns2:ItemDimensions><ns2:Height Units="inches">4.5</ns2:Height><ns2:Length Units="inches">12.0</ns2:Length>'
+        f'<ns2:Width Units="inches">8.25</ns2:Width><ns2:Weight Units="pounds">2.1</ns2:Weight></ns2:ItemDimensions>'
+        f'<ns2:Label>Label {i % 5}</ns2:Label>'
+        f'<ns2:ListPrice><ns2:Amount>{19.99 + i:.2f}</ns2:Amount><ns2:CurrencyCode>USD</ns2:CurrencyCode>'
+        f'</ns2:ListPrice>'
+        f'<ns2:Manufacturer>Manufacturer {i % 5}</ns2:Manufacturer><ns2:Model>MDL-{i:05d}</ns2:Model>'
+        f'<ns2:NumberOfItems>1</ns2:NumberOfItems><ns2:PackageQuantity>{1 + i % 3}</ns2:PackageQuantity>'
+        f'<ns2:PartNumber>PN-{i:05d}</ns2:PartNumber><ns2:ProductGroup>Kitchen</ns2:ProductGroup>'
+        f'<ns2:Publisher>Publisher {i % 5}</ns2:Publisher>'
+        f'<ns2:SmallImage><ns2:URL>http://ecx.images-amazon.com/images/I/{asin(i)}._SL75_.jpg</ns2:URL>'
+        f'<ns2:Height Units="pixels">75</ns2:Height><ns2:Width Units="pixels">75</ns2:Width></ns2:SmallImage>'
+        f'<ns2:Studio>Studio {i % 5}</ns2:Studio>'
+        f'<ns2:Title>Product {i} - Commercial Grade Stainless Steel Thing, 12 Inch</ns2:Title>'
+        f'</ns2:ItemAttributes></AttributeSets>'
+        f'<Relationships/>'
+        f'<SalesRankings>'
+        f'<SalesRank><ProductCategoryId>kitchen_display_on_website</ProductCategoryId><Rank>{1000 + i}</Rank></SalesRank>'
+        f'<SalesRank><ProductCategoryId>289814</ProductCategoryId><Rank>{10 + i}</Rank></SalesRank>'
+        f'</SalesRankings>'
+        f'</Product>'
+        for i in range(n)
+    )
+
+    return f'<?xml version="1.0"?>' \
+           f'<ListMatchingProductsResponse xmlns="{MWS_PRODUCTS_NS}">' \
+           f'<ListMatchingProductsResult><Products xmlns:ns2="{MWS_ATTRIBUTES_NS}">{products}</Products>' \
+           f'</ListMatchingProductsResult>{_response_metadata()}</ListMatchingProductsResponse>'
+
+
+def get_my_fees_estimate(n=1):
+    results = ''.join(
+        f'<FeesEstimateResult>'
+        f'<FeesEstimateIdentifier><MarketplaceId>ATVPDKIKX0DER</MarketplaceId><IdType>ASIN</IdType>'
+        f'<SellerId>A1SELLER</SellerId><SellerInputIdentifier>{asin(i)}@{19.99 + i:.2f}</SellerInputIdentifier>'
+        f'<IsAmazonFulfilled>true</IsAmazonFulfilled><IdValue>{asin(i)}</IdValue>'
+        f'<PriceToEstimateFees><ListingPrice><CurrencyCode>USD</CurrencyCode><Amount>{19.99 + i:.2f}</Amount>'
+        f'</ListingPrice></PriceToEstimateFees></FeesEstimateIdentifier>'
+        f'<FeesEstimate><TimeOfFeesEstimation>2017-08-01T12:00:00.000Z</TimeOfFeesEstimation>'
+        f'<TotalFeesEstimate><CurrencyCode>USD</CurrencyCode><Amount>{5.5 + i * 0.1:.2f}</Amount></TotalFeesEstimate>'
+        f'<FeeDetailList>'
+        + ''.join(f'<FeeDetail><FeeType>{fee}</FeeType>'
+                  f'<FeeAmount><CurrencyCode>USD</CurrencyCode><Amount>1.00</Amount></FeeAmount>'
+                  f'<FinalFee><CurrencyCode>USD</CurrencyCode><Amount>1.00</Amount></FinalFee></FeeDetail>'
+                  for fee in ('ReferralFee', 'VariableClosingFee', 'PerItemFee', 'FBAFees')) +
+        f'</FeeDetailList></FeesEstimate>'
+        f'<Status>Success</Status></FeesEstimateResult>'
+        for i in range(n)
+    )
+
+    return f'<?xml version="1.0"?>' \
+           f'<GetMyFeesEstimateResponse xmlns="{MWS_PRODUCTS_NS}">' \
+           f'<GetMyFeesEstimateResult><FeesEstimateResultList>{results}</FeesEstimateResultList>' \
+           f'</GetMyFeesEstimateResult>{_response_metadata()}</GetMyFeesEstimateResponse>'
+
+
+def get_competitive_pricing_for_asin(n=1):
+    results = ''.join(
+        f'<GetCompetitivePricingForASINResult ASIN="{asin(i)}" status="Success"><Product>'
+        f'<Identifiers><MarketplaceASIN><MarketplaceId>ATVPDKIKX0DER</MarketplaceId><ASIN>{asin(i)}</ASIN>'
+        f'</MarketplaceASIN></Identifiers>'
+        f'<CompetitivePricing><CompetitivePrices>'
+        + ''.join(f'<CompetitivePrice belongsToRequester="false" condition="{condition}" subcondition="{condition}">'
+                  f'<CompetitivePriceId>{c + 1}</CompetitivePriceId><Price>'
+                  f'<LandedPrice><CurrencyCode>USD</CurrencyCode><Amount>{24.99 + i - c:.2f}</Amount></LandedPrice>'
+                  f'<ListingPrice><CurrencyCode>USD</CurrencyCode><Amount>{19.99 + i - c:.2f}</Amount></ListingPrice>'
+                  f'<Shipping><CurrencyCode>USD</CurrencyCode><Amount>5.00</Amount></Shipping>'
+                  f'</Price></CompetitivePrice>'
+                  for c, condition in enumerate(('New', 'Used'))) +
+        f'</CompetitivePrices><NumberOfOfferListings>'
+        f'<OfferListingCount condition="New">{3 + i % 10}</OfferListingCount>'
+        f'<OfferListingCount condition="Used">{i % 4}</OfferListingCount>'
+        f'<OfferListingCount condition="Any">{3 + i % 10 + i % 4}</OfferListingCount>'
+        f'</NumberOfOfferListings></CompetitivePricing>'
+        f'<SalesRankings><SalesRank><ProductCategoryId>kitchen_display_on_website</ProductCategoryId>'
+        f'<Rank>{1000 + i}</Rank></SalesRank></SalesRankings>'
+        f'</Product></GetCompetitivePricingForASINResult>'
+        for i in range(n)
+    )
+
+    return f'<?xml version="1.0"?>' \
+           f'<GetCompetitivePricingForASINResponse xmlns="{MWS_PRODUCTS_NS}">' \
+           f'{results}{_response_metadata()}</GetCompetitivePricingForASINResponse>'
+
+
+def item_lookup(n=1):
+    items = ''.join(
+        f'<Item><ASIN>{asin(i)}</ASIN>'
+        f'<DetailPageURL>https://www.amazon.com/dp/{asin(i)}</DetailPageURL>'
+        f'<SalesRank>{1000 + i}</SalesRank>'
+        f'<SmallImage><URL>https://images-na.ssl-images-amazon.com/images/I/{asin(i)}._SL75_.jpg</URL></SmallImage>'
+        f'<LargeImage><URL>https://images-na.ssl-images-amazon.com/images/I/{asin(i)}.jpg</URL>'
+        f'<Height Units="pixels">500</Height><Width Units="pixels">500</Width></LargeImage>'
+        f'<ImageSets><ImageSet Category="primary">'
+        f'<SwatchImage><URL>https://images-na.ssl-images-amazon.com/images/I/{asin(i)}._SL30_.jpg</URL></SwatchImage>'
+        f'<LargeImage><URL>https://images-na.ssl-images-amazon.com/images/I/{asin(i)}.jpg</URL></LargeImage>'
+        f'</ImageSet></ImageSets>'
+        f'<ItemAttributes><Binding>Kitchen</Binding><Brand>Brand {i % 7}</Brand><EAN>0{i:012d}</EAN>'
+        + ''.join(f'<Feature>Feature {j} of product {i}, with a typical amount of marketing text.</Feature>'
+                  for j in range(5)) +
+        f'<Label>Label {i % 5}</Label><ListPrice><Amount>{1999 + i}</Amount><CurrencyCode>USD</CurrencyCode>'
+        f'<FormattedPrice>${19.99 + i / 100:.2f}</FormattedPrice></ListPrice>'
+        f'<Manufacturer>Manufacturer {i % 5}</Manufacturer><Model>MDL-{i:05d}</Model><MPN>MPN-{i:05d}</MPN>'
+        f'<NumberOfItems>1</NumberOfItems><PackageQuantity>{1 + i % 3}</PackageQuantity>'
+        f'<PartNumber>PN-{i:05d}</PartNumber><Publisher>Publisher {i % 5}</Publisher>'
+        f'<Studio>Studio {i % 5}</Studio><Title>Product {i} - Commercial Grade Stainless Steel Thing, 12 Inch</Title>'
+        f'<UPC>{i:012d}</UPC></ItemAttributes>'
+        f'<OfferSummary><LowestNewPrice><Amount>{1799 + i}</Amount><CurrencyCode>USD</CurrencyCode>'
+        f'<FormattedPrice>${17.99 + i / 100:.2f}</FormattedPrice></LowestNewPrice>'
+        f'<TotalNew>{3 + i % 10}</TotalNew><TotalUsed>0</TotalUsed></OfferSummary>'
+        f'<Offers><TotalOffers>1</TotalOffers><Offer><Merchant><Name>Amazon.com</Name></Merchant>'
+        f'<OfferAttributes><Condition>New</Condition></OfferAttributes>'
+        f'<OfferListing><Price><Amount>{1799 + i}</Amount><CurrencyCode>USD</CurrencyCode></Price>'
+        f'<IsEligibleForPrime>1</IsEligibleForPrime></OfferListing></Offer></Offers>'
+        f'<EditorialReviews><EditorialReview><Source>Product Description</Source>'
+        f'<Content>{"A long product description with &lt;b&gt;markup&lt;/b&gt;. " * 40}</Content>'
+        f'<IsLinkSuppressed>0</IsLinkSuppressed></EditorialReview></EditorialReviews>'
+        f'</Item>'
+        for i in range(n)
+    )
+
+    item_ids = ','.join(asin(i) for i in range(n))
+    return f'<?xml version="1.0" ?>' \
+           f'<ItemLookupResponse xmlns="{PA_NS}">' \
+           f'<OperationRequest><RequestId>7a2f7bbd-2a54-4e0b-a0b5-9c0e3c1f0a11</RequestId>' \
+           f'<RequestProcessingTime>0.0123</RequestProcessingTime></OperationRequest>' \
+           f'<Items><Request><IsValid>True</IsValid><ItemLookupRequest><IdType>ASIN</IdType>' \
+           f'<ItemId>{item_ids}</ItemId><ResponseGroup>Images</ResponseGroup>' \
+           f'<VariationPage>All</VariationPage></ItemLookupRequest></Request>{items}</Items></ItemLookupResponse>'
+
+
+# Action name -> fixture generator
+generators = {
+    'GetServiceStatus': get_service_status,
+    'ListMatchingProducts': list_matching_products,
+    'GetMyFeesEstimate': get_my_fees_estimate,
+    'GetCompetitivePricingForASIN': get_competitive_pricing_for_asin,
+    'ItemLookup': item_lookup
+}
@@ -0,0 +1,89 @@
+"""Benchmark the Redis quota limiter against the old approach of building a new script for every call.
+
+Run from the worker directory, against a local Redis:
+
+    REDIS_URL=redis://localhost:6379 python -m bench.limiter --calls 20000 --processes 4
+"""
+import argparse
+import multiprocessing
+import os
+import time
+import redis
+
+from mws.limiter import QuotaLimiter
+
+
+########################################################################################################################
+
+
+def legacy_reserve(r, key, quota_max, restore_rate, expires=200):
+    """The reservation as it was done before mws.limiter: the current time and key are written into the script text,
+    so every call sends (and Redis compiles and caches) a new script."""
+    now = time.monotonic()
+    script = f"""
+    local usage = redis.call('HMGET', '{key}', 'quota_level', 'pending', 'last_request')
+    local quota_level = tonumber(usage[1]) or 0
+    local pending = tonumber(usage[2]) or 0
+    local last_request = tonumber(usage[3]) or 0
+
+    if last_request > 0 then
+        quota_level = math.max(quota_level - ({now} - last_request) / {restore_rate}, 0)
+        redis.call('HSET', '{key}', 'quota_level', quota_level)
+    end
+
+    redis.call('HINCRBY', '{key}', 'pending', 1)
+    redis.call('EXPIRE', '{key}', {expires})
+    return {{tostring(quota_level), pending, tostring(last_request)}}
+    """
+    return r.eval(script, 0)
+
+
+def run(args):
+    mode, calls, key = args
+    r = redis.from_url(os.environ.get('REDIS_URL', 'redis://'))
+
+    if mode == 'legacy':
+        reserve = lambda: legacy_reserve(r, key, 20, 0.1)
+    else:
+        limiter = QuotaLimiter(r)
+        reserve = lambda: limiter.reserve(key, 20, 0.1)
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        reserve()
+    return time.perf_counter() - start
+
+
+def benchmark(mode, calls, processes):
+    r = redis.from_url(os.environ.get('REDIS_URL', 'redis://'))
+    key = f'bench_limiter_{mode}_usage'
+    r.delete(key)
+    r.script_flush()
+
+    per_process = calls // processes
+    start = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        pool.map(run, [(mode, per_process, key)] * processes)
+    elapsed = time.perf_counter() - start
+
+    memory = r.info('memory')
+    r.delete(key)
+
+    print(f'{mode:>8}: {per_process * processes / elapsed:10.0f} calls/sec  '
+          f'cached scripts: {memory.get("number_of_cached_scripts", "n/a"):>6}  '
+          f'script memory: {memory.get("used_memory_scripts", memory.get("used_memory_lua", 0)) / 1024:8.1f} KiB')
+
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=10000)
+    parser.add_argument('--processes', type=int, default=4)
+    args = parser.parse_args()
+
+    for mode in ('legacy', 'limiter'):
+        benchmark(mode, args.calls, args.processes)
+
+    redis.from_url(os.environ.get('REDIS_URL', 'redis://')).script_flush()
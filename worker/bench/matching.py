@@ -0,0 +1,220 @@
+"""Load test the Amazon listing updates that find_amazon_matches() starts for the matches it imports: the per-match
+workflow it used to start (a chord of ItemLookup and GetCompetitivePricingForASIN for every match, followed by
+update_fba_fees), against listing_workflow(), which takes a whole batch of matches through lookup, pricing and fees
+with one chord. For each, reports the number of chords, the Redis commands issued, and the end-to-end latency until
+every listing has been updated.
+
+The mws.* tasks are replaced by fakes that wait --api-latency seconds and return synthetic responses for the requested
+ASINs, and a worker is started in this process. Everything else is real, so REDIS_URL and MONGODB_URI have to point to
+disposable servers that nothing else is using: the Redis command counts come from INFO commandstats, and include the
+worker's own broker polling. The end of a run is detected from the database and the worker's state, without polling
+the task results, so that waiting for them isn't counted. The test products are deleted afterwards.
+
+Run from the worker directory:
+
+    python -m bench.matching --matches 20 100 500 --api-latency 0.2
+"""
+import argparse
+import json
+import re
+import time
+from unittest import mock
+
+import redis
+from bson import ObjectId
+from celery import chain, chord
+from celery.contrib.testing.worker import start_worker
+from celery.worker import state
+
+import mws.products
+import mws.product_adv
+from worker import app
+from ops.common import OpsTask, get_db, vendor_cache, dirty_products_key
+from ops.products import ItemLookup, GetCompetitivePricingForASIN, update_amazon_listing, update_fba_fees, \
+    listing_workflow
+from . import fixtures
+
+
+########################################################################################################################
+
+
+class FakeAPI:
+    """Stands in for the mws.* task module.action: waits latency seconds, then returns a synthetic response for the
+    requested items. Result caching is disabled, so every run makes the same calls."""
+    cache_ttl = 0
+    fresh_for = 0
+
+    def __init__(self, module, action, latency):
+        self.action = action
+        self.batch_size = getattr(module, action).batch_size
+        self.latency = latency
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        return fake_response(self.action, kwargs)
+
+
+def fake_response(action, params):
+    """Return the synthetic response for action, with the fixture ASINs replaced by the requested ones."""
+    identifiers = None
+    if action == 'GetMyFeesEstimate':
+        entries = params['FeesEstimateRequestList']
+        asins = [entry['IdValue'] for entry in entries]
+        identifiers = iter(entry['Identifier'] for entry in entries)
+    elif action == 'GetCompetitivePricingForASIN':
+        asins = params['ASINList']
+    else:
+        asins = params['ItemId'].split(',')
+
+    xml = re.sub(r'B(\d{9})', lambda m: asins[int(m.group(1))], fixtures.generators[action](len(asins)))
+    if identifiers is not None:
+        xml = re.sub(r'(?<=<SellerInputIdentifier>)[^<]*', lambda m: next(identifiers), xml)
+
+    return xml
+
+
+def legacy_workflow(listings):
+    """Return the canvases find_amazon_matches() used to start: one chain for each match."""
+    return [
+        chain(
+            chord([ItemLookup.s(asin), GetCompetitivePricingForASIN.s(asin)], update_amazon_listing.s(str(product_id))),
+            update_fba_fees.s()
+        ) for asin, product_id in listings.items()
+    ]
+
+
+def batched_workflow(listings, batch_size):
+    """Return the canvases find_amazon_matches() starts now: one listing_workflow() per batch of matches."""
+    asins = list(listings)
+    return [
+        listing_workflow({asin: listings[asin] for asin in asins[start:start + batch_size]})
+        for start in range(0, len(asins), batch_size)
+    ]
+
+
+workflows = {
+    'legacy': lambda listings, batch_size: legacy_workflow(listings),
+    'batched': batched_workflow
+}
+
+
+########################################################################################################################
+
+
+def command_calls(client):
+    """Return a dictionary of Redis command -> number of calls since the server started."""
+    return {name.replace('cmdstat_', ''): stats['calls'] for name, stats in client.info('commandstats').items()}
+
+
+def seed_listings(db, prefix, count):
+    """Insert count Amazon products, and return a dictionary of ASIN -> product ID."""
+    amz_id = vendor_cache.get_or_create_id(db, 'Amazon')
+    docs = [{'vendor': amz_id, 'sku': f'{prefix}{i:07d}', 'price': 1.0, 'bench': prefix} for i in range(count)]
+    db.products.insert_many(docs)
+    return {doc['sku']: doc['_id'] for doc in docs}
+
+
+def wait_until_done(db, prefix, count, timeout):
+    """Wait until every listing with prefix has fees, and the worker has nothing left to do."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not state.active_requests and not state.reserved_requests \
+                and db.products.count_documents({'bench': prefix, 'market_fees': {'$exists': True}}) >= count:
+            return
+        time.sleep(0.01)
+
+    raise TimeoutError(f'Not every listing was updated after {timeout} seconds')
+
+
+def measure(name, count, batch_size, db, client, timeout):
+    """Update count new listings with a workflow, and return its statistics."""
+    prefix = 'L' + str(ObjectId())[-2:].upper()
+    listings = seed_listings(db, prefix, count)
+
+    try:
+        canvases = workflows[name](listings, batch_size)
+        chords = len(canvases)  # Each canvas has one chord
+
+        before = command_calls(client)
+        start = time.perf_counter()
+        results = [canvas.apply_async() for canvas in canvases]
+        wait_until_done(db, prefix, count, timeout)
+        elapsed = time.perf_counter() - start
+        after = command_calls(client)
+
+        # Raise any errors, now that it doesn't affect the counts
+        for result in results:
+            result.get(timeout=timeout)
+
+        updated = db.products.count_documents({'bench': prefix, 'market_fees': {'$exists': True}})
+    finally:
+        db.products.delete_many({'bench': prefix})
+        client.srem(dirty_products_key, *[str(product_id) for product_id in listings.values()])
+
+    commands = {command: calls - before.get(command, 0) for command, calls in after.items()}
+    commands = {command: calls for command, calls in commands.items() if calls}
+    return {
+        'workflow': name,
+        'matches': count,
+        'updated': updated,
+        'chords': chords,
+        'redis_commands': sum(commands.values()),
+        'commands_per_match': sum(commands.values()) / count,
+        'latency_s': elapsed,
+        'top_commands': dict(sorted(commands.items(), key=lambda item: -item[1])[:5])
+    }
+
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--matches', type=int, nargs='+', default=[20, 100, 500])
+    parser.add_argument('--workflows', nargs='+', choices=list(workflows), default=list(workflows))
+    parser.add_argument('--batch-size', type=int, default=OpsTask.bulk_batch_size)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds each fake API call takes')
+    parser.add_argument('--concurrency', type=int, default=8, help='worker threads')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--json', help='also write the results to this file, for comparing runs')
+    args = parser.parse_args()
+
+    db = get_db()
+    client = redis.from_url(app.conf.broker_url)
+    fakes = {
+        (module, action): FakeAPI(module, action, args.api_latency) for module, action in [
+            (mws.product_adv, 'ItemLookup'),
+            (mws.products, 'GetCompetitivePricingForASIN'),
+            (mws.products, 'GetMyFeesEstimate')
+        ]
+    }
+
+    results = []
+    patches = [mock.patch.object(module, action, fake) for (module, action), fake in fakes.items()]
+    for patch in patches:
+        patch.start()
+
+    try:
+        with start_worker(app, pool='threads', concurrency=args.concurrency, perform_ping_check=False):
+            print(f'{"workflow":<10}{"matches":>8}{"updated":>8}{"chords":>8}{"API calls":>10}{"Redis cmds":>11}'
+                  f'{"cmds/match":>11}{"latency s":>10}  top commands')
+            for count in args.matches:
+                for name in args.workflows:
+                    calls = sum(fake.calls for fake in fakes.values())
+                    stats = measure(name, count, args.batch_size, db, client, args.timeout)
+                    stats['api_calls'] = sum(fake.calls for fake in fakes.values()) - calls
+                    results.append(stats)
+
+                    top = ' '.join(f'{command}={calls}' for command, calls in stats['top_commands'].items())
+                    print(f'{name:<10}{count:>8}{stats["updated"]:>8}{stats["chords"]:>8}{stats["api_calls"]:>10}'
+                          f'{stats["redis_commands"]:>11}{stats["commands_per_match"]:>11.1f}'
+                          f'{stats["latency_s"]:>10.2f}  {top}')
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,155 @@
+"""Benchmark the parsed.* tasks on synthetic and recorded responses, with the mws.* tasks mocked out, so that nothing
+but the parsers themselves is measured. For each action and fixture, reports the throughput in items per second, the
+per-item latency percentiles, and the peak memory allocated during one call.
+
+Recorded responses can be added with --recorded: every *.xml file in the directory whose name starts with an action
+name (e.g. ItemLookup-books.xml) is run through that action's parser.
+
+Run from the worker directory:
+
+    python -m bench.parsers --repeat 50
+    python -m bench.parsers --sizes 20 1000 --recorded ~/mws-responses --json after.json
+"""
+import argparse
+import json
+import os
+import re
+import time
+import tracemalloc
+from unittest import mock
+
+import mws.products
+import mws.product_adv
+import parsed.products
+import parsed.product_adv
+from . import fixtures
+
+
+########################################################################################################################
+
+
+class FakeTask:
+    """Stands in for an mws.* task: returns the same response every time, and disables the parsed result caches."""
+    cache_ttl = 0
+    fresh_for = 0
+
+    def __init__(self, xml):
+        self.xml = xml
+
+    def __call__(self, *args, **kwargs):
+        return self.xml
+
+
+def item_ids(xml, action):
+    """Return the IDs of the items in a response, so the parser can be called with matching parameters."""
+    if action == 'GetMyFeesEstimate':
+        return re.findall(r'<SellerInputIdentifier>([^<]+)</SellerInputIdentifier>', xml)
+    elif action == 'GetCompetitivePricingForASIN':
+        return re.findall(r'<GetCompetitivePricingForASINResult[^>]* ASIN="([^"]+)"', xml)
+    elif action == 'ItemLookup':
+        return re.findall(r'<Item><ASIN>([^<]+)</ASIN>', xml)
+    elif action == 'ListMatchingProducts':
+        return re.findall(r'<Product>', xml)
+    return [None]
+
+
+def parser_call(action, ids):
+    """Return the parser for action, bound to parameters that request the given items."""
+    if action == 'ListMatchingProducts':
+        return lambda: parsed.products.ListMatchingProducts(query='benchmark')
+    elif action == 'GetMyFeesEstimate':
+        estimates = [identifier.split('@') for identifier in ids]
+        return lambda: parsed.products.GetMyFeesEstimate(estimates=estimates, coalesce=False)
+    elif action == 'GetCompetitivePricingForASIN':
+        return lambda: parsed.products.GetCompetitivePricingForASIN(ASINList=ids, coalesce=False, use_cache=False)
+    elif action == 'ItemLookup':
+        return lambda: parsed.product_adv.ItemLookup(ItemId=','.join(ids), coalesce=False, use_cache=False)
+    return lambda: parsed.products.GetServiceStatus()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def measure(action, xml, repeat):
+    """Run the parser for action on xml repeat times, and return its statistics."""
+    ids = item_ids(xml, action)
+    items = max(len(ids), 1)
+    module = mws.product_adv if action == 'ItemLookup' else mws.products
+
+    with mock.patch.object(module, action, FakeTask(xml)):
+        call = parser_call(action, ids)
+        call()  # Warm up, and compile anything compiled on first use
+
+        tracemalloc.start()
+        call()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+
+    per_item = [t / items * 1e6 for t in timings]
+    return {
+        'items': items,
+        'kib': len(xml) / 1024,
+        'items_per_sec': items * repeat / sum(timings),
+        'p50_us': percentile(per_item, 50),
+        'p90_us': percentile(per_item, 90),
+        'p99_us': percentile(per_item, 99),
+        'peak_kib': peak / 1024
+    }
+
+
+def load_fixtures(sizes, recorded=None):
+    """Return a list of (action, fixture name, xml) tuples: the synthetic fixtures at each size, then any recorded
+    responses."""
+    corpus = []
+    for action, generate in fixtures.generators.items():
+        for size in ([1] if action == 'GetServiceStatus' else sizes):
+            corpus.append((action, f'synthetic-{size}', generate(size)))
+
+    if recorded:
+        for filename in sorted(os.listdir(recorded)):
+            action = next((a for a in fixtures.generators if filename.startswith(a)), None)
+            if action is None or not filename.endswith('.xml'):
+                continue
+
+            with open(os.path.join(recorded, filename)) as file:
+                corpus.append((action, filename, file.read()))
+
+    return corpus
+
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 20, 1000])
+    parser.add_argument('--recorded', help='directory of recorded responses')
+    parser.add_argument('--actions', nargs='+', help='only benchmark these actions')
+    parser.add_argument('--json', help='also write the results to this file, for comparing runs')
+    args = parser.parse_args()
+
+    results = []
+    print(f'{"action":<30}{"fixture":<20}{"items":>6}{"KiB":>9}{"items/s":>11}'
+          f'{"p50 us":>9}{"p90 us":>9}{"p99 us":>9}{"peak KiB":>10}')
+    for action, name, xml in load_fixtures(args.sizes, args.recorded):
+        if args.actions and action not in args.actions:
+            continue
+
+        # Keep the large fixtures from taking forever
+        stats = measure(action, xml, max(args.repeat // max(len(xml) // 500000, 1), 3))
+        results.append({'action': action, 'fixture': name, **stats})
+        print(f'{action:<30}{name:<20}{stats["items"]:>6}{stats["kib"]:>9.1f}{stats["items_per_sec"]:>11.0f}'
+              f'{stats["p50_us"]:>9.1f}{stats["p90_us"]:>9.1f}{stats["p99_us"]:>9.1f}{stats["peak_kib"]:>10.1f}')
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
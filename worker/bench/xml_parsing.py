@@ -0,0 +1,100 @@
+"""Compare the old regex-based namespace removal in AmzXmlResponse with the current namespace-aware parser, which
+parses each response once without rewriting it.
+
+Run from the worker directory:
+
+    python -m bench.xml_parsing --repeat 200
+"""
+import argparse
+import re
+import time
+from lxml import etree
+
+from parsed.common import AmzXmlResponse
+from . import fixtures
+
+
+########################################################################################################################
+
+
+class LegacyAmzXmlResponse(AmzXmlResponse):
+    """AmzXmlResponse as it was before parsing was reworked: the namespaces are removed from the text with three
+    regular expressions compiled on every call, the result is parsed, and every XPath is compiled on every use."""
+
+    @property
+    def xml(self):
+        return self._xml
+
+    @xml.setter
+    def xml(self, xml):
+        self._xml, self.tree = None, None
+
+        if xml is not None:
+            self._xml = self.remove_namespaces(xml)
+            self.tree = etree.fromstring(self._xml)
+
+    @staticmethod
+    def remove_namespaces(xml):
+        re_ns_decl = re.compile(r' xmlns(:\w*)?="[^"]*"', re.IGNORECASE)
+        re_ns_open = re.compile(r'<\w+:')
+        re_ns_close = re.compile(r'/\w+:')
+
+        response = re_ns_decl.sub('', xml)
+        response = re_ns_open.sub('<', response)
+        response = re_ns_close.sub('/', response)
+        return response
+
+    def xpath_get(self, path, root_tag=None, _type=str, default=None):
+        tag = root_tag if root_tag is not None else self.tree
+        try:
+            data = tag.xpath(path)[0].text
+            if _type is str and data is None:
+                raise TypeError
+            else:
+                return _type(data)
+        except (IndexError, ValueError, TypeError):
+            return default
+
+
+# A few lookups per item, like the parsers do
+item_tags = {
+    'ListMatchingProducts': ('Product', ('.//ASIN', './/Brand', './/Model', './/ListPrice/Amount', './/Title')),
+    'GetMyFeesEstimate': ('FeesEstimateResult', ('.//SellerInputIdentifier', './Status', './/TotalFeesEstimate/Amount')),
+    'GetCompetitivePricingForASIN': ('GetCompetitivePricingForASINResult', ('.//ListingPrice/Amount',
+                                                                            './/Shipping/Amount',
+                                                                            './/LandedPrice/Amount')),
+    'ItemLookup': ('Item', ('.//ASIN', './/SalesRank', './/LargeImage/URL', './/Brand', './/Model', './/Title',
+                            './/EditorialReview/Content', './/LowestNewPrice/Amount')),
+    'GetServiceStatus': ('GetServiceStatusResult', ('.//Status',))
+}
+
+
+def measure(response_cls, xml, tag, paths, repeat):
+    """Return the average time to parse xml and read paths from each item, in milliseconds."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        response = response_cls(xml)
+        for item in response.tree.iterdescendants('{*}' + tag):
+            for path in paths:
+                response.xpath_get(path, item)
+
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 20, 100])
+    args = parser.parse_args()
+
+    print(f'{"action":<30}{"items":>6}{"KiB":>8}{"before ms":>12}{"after ms":>12}{"speedup":>10}')
+    for action, generate in fixtures.generators.items():
+        tag, paths = item_tags[action]
+        for size in args.sizes:
+            xml = generate(size)
+            before = measure(LegacyAmzXmlResponse, xml, tag, paths, args.repeat)
+            after = measure(AmzXmlResponse, xml, tag, paths, args.repeat)
+            print(f'{action:<30}{size:>6}{len(xml) / 1024:>8.1f}{before:>12.3f}{after:>12.3f}{before / after:>9.2f}x')
@@ -0,0 +1,122 @@
+import json
+import math
+import time
+import uuid
+
+from worker import Throttled
+
+
+########################################################################################################################
+
+
+class BatchCallError(Exception):
+    """Raised in every caller of a coalesced batch when the batched API call fails. If the call is throttled, every
+    caller raises Throttled instead."""
+    pass
+
+
+class Coalescer:
+    """Combines requests from many tasks (and many workers) into a single batched call, using Redis as the meeting
+    point.
+
+    Each caller pushes a ticket with its items onto a shared queue. Whoever holds the lease becomes the leader: it waits
+    until the queue holds batch_size items or batch_window seconds have passed, pops one batch, makes the call, and
+    pushes the result to each ticket's result key. Everyone else blocks on their own result key. The lease expires on
+    its own, so a crashed leader can only hold up the queue for lease_timeout seconds.
+
+    Every caller waits for its result synchronously, in its own task slot, so a batch can only hold as many callers as
+    there are tasks running at the same time: batch_size is effectively capped by the total worker concurrency."""
+
+    def __init__(self, redis, name, batch_size=20, batch_window=0.25, lease_timeout=60, result_expires=60):
+        self.redis = redis
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.lease_timeout = lease_timeout
+        self.result_expires = result_expires
+
+        self.queue_key = f'{name}_queue'
+        self.lease_key = f'{name}_lease'
+        self.opened_key = f'{name}_opened'
+
+    def result_key(self, ticket):
+        return f'{self.queue_key}_{ticket}'
+
+    def submit(self, items, call, timeout=None):
+        """Queue items for the next batch and return the result of the call that includes them. call() receives the
+        merged list of items and must return a JSON-serializable value."""
+        ticket = uuid.uuid4().hex
+        timeout = timeout or self.lease_timeout * 2
+        deadline = time.time() + timeout
+
+        pipe = self.redis.pipeline()
+        pipe.rpush(self.queue_key, json.dumps({'ticket': ticket, 'items': items}))
+        pipe.expire(self.queue_key, self.lease_timeout * 2)
+        pipe.set(self.opened_key, time.time(), nx=True, ex=self.lease_timeout)
+        pipe.execute()
+
+        while time.time() < deadline:
+            if self.redis.set(self.lease_key, ticket, nx=True, ex=self.lease_timeout):
+                try:
+                    self._lead(call)
+                finally:
+                    if self.redis.get(self.lease_key) == ticket.encode():
+                        self.redis.delete(self.lease_key)
+
+            wait = max(math.ceil(self.batch_window * 2), 1)
+            reply = self.redis.blpop(self.result_key(ticket), timeout=wait)
+            if reply is not None:
+                reply = json.loads(reply[1])
+                if 'throttled' in reply:
+                    raise Throttled(reply['throttled'])
+                elif 'error' in reply:
+                    raise BatchCallError(reply['error'])
+                return reply['value']
+
+        raise TimeoutError(f'No result for batch ticket {ticket} after {timeout} seconds')
+
+    def _lead(self, call):
+        """Wait for the batch to fill up or for the window to close, then make one call and distribute the result."""
+        while True:
+            opened = float(self.redis.get(self.opened_key) or 0)
+            if self.redis.llen(self.queue_key) >= self.batch_size or time.time() - opened >= self.batch_window:
+                break
+            time.sleep(self.batch_window / 5)
+
+        # Only the leader pops from the queue, so reading and trimming in one transaction is enough
+        pipe = self.redis.pipeline()
+        pipe.lrange(self.queue_key, 0, self.batch_size - 1)
+        pipe.delete(self.opened_key)
+        entries = [json.loads(entry) for entry in pipe.execute()[0]]
+
+        tickets, items = [], []
+        for entry in entries:
+            new_items = [item for item in entry['items'] if item not in items]
+            if tickets and len(items) + len(new_items) > self.batch_size:
+                break
+            tickets.append(entry['ticket'])
+            items.extend(new_items)
+
+        if not tickets:
+            return
+
+        pipe = self.redis.pipeline()
+        pipe.ltrim(self.queue_key, len(tickets), -1)
+        pipe.llen(self.queue_key)
+        if pipe.execute()[-1]:
+            self.redis.set(self.opened_key, time.time(), nx=True, ex=self.lease_timeout)
+
+        print(f'{self.queue_key}: sending batch of {len(items)} items for {len(tickets)} callers')
+        try:
+            reply = {'value': call(items)}
+        except Throttled as e:
+            # Everyone in the batch backs off and tries again, instead of failing
+            reply = {'throttled': e.countdown}
+        except Exception as e:
+            reply = {'error': f'{type(e).__name__}: {e}'}
+
+        reply = json.dumps(reply)
+        pipe = self.redis.pipeline()
+        for ticket in tickets:
+            pipe.rpush(self.result_key(ticket), reply)
+            pipe.expire(self.result_key(ticket), self.result_expires)
+        pipe.execute()
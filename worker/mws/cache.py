@@ -0,0 +1,154 @@
+import os
+import time
+import zlib
+from collections import OrderedDict
+
+
+########################################################################################################################
+
+
+class LRUCache:
+    """A bounded, in-process LRU cache where every entry has its own expiration time."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Return the value stored under key, or None if it is missing or expired."""
+        entry = self.get_entry(key)
+        return entry[1] if entry is not None else None
+
+    def get_entry(self, key):
+        """Return an (expires_at, value) tuple for key, or None if it is missing or expired."""
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if entry[0] <= time.time():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key, value, expires_at):
+        """Store value under key until the given timestamp, evicting the least recently used entries if necessary."""
+        if self.maxsize <= 0:
+            return
+
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+# Shared by every task in the worker process
+local_cache = LRUCache(int(os.environ.get('MWS_LOCAL_CACHE_SIZE', 256)))
+
+
+########################################################################################################################
+
+
+class ResponseCache:
+    """A two-tier cache for API responses. Values are looked up in the in-process LRU first, then in Redis, where they
+    are stored zlib-compressed. Redis lookups take a single round trip, and also return the remaining TTL so that the
+    local copy expires at the same time as the Redis entry."""
+    compressed_prefix = b'zlib:'
+
+    def __init__(self, redis, local=None, compress_min=1024):
+        self.redis = redis
+        self.local = local if local is not None else local_cache
+        self.compress_min = compress_min
+
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+    def get(self, key):
+        """Return the value stored under key, or None."""
+        entry = self.get_entry(key)
+        return entry[1] if entry is not None else None
+
+    def get_entry(self, key, stale_ttl=0):
+        """Return an (expires_at, value) tuple for key, or None. Entries are stale for the last stale_ttl seconds before
+        they expire; stale local copies are looked up again in Redis, where another process may have refreshed them."""
+        entry = self.local.get_entry(key)
+        if entry is not None and entry[0] - stale_ttl > time.time():
+            return entry
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        data, pttl = pipe.execute()
+
+        if data is None:
+            self.redis_misses += 1
+            return None
+
+        self.redis_hits += 1
+        entry = (time.time() + pttl / 1000 if pttl > 0 else time.time(), self.decode(data))
+        if pttl > 0:
+            self.local.set(key, entry[1], entry[0])
+
+        return entry
+
+    def set(self, key, value, ttl):
+        """Store value under key for ttl seconds."""
+        self.redis.set(key, self.encode(value), ex=ttl)
+        self.local.set(key, value, time.time() + ttl)
+
+    def delete(self, key):
+        self.redis.delete(key)
+        self.local.delete(key)
+
+    def encode(self, value):
+        data = value.encode()
+        if len(data) < self.compress_min:
+            return data
+
+        return self.compressed_prefix + zlib.compress(data)
+
+    def decode(self, data):
+        if data.startswith(self.compressed_prefix):
+            data = zlib.decompress(data[len(self.compressed_prefix):])
+
+        return data.decode()
+
+    @property
+    def stats(self):
+        return {
+            'local': self.local.stats,
+            'redis': {
+                'hits': self.redis_hits,
+                'misses': self.redis_misses
+            }
+        }
@@ -2,12 +2,16 @@ import hashlib
 import json
 import redis
 import requests
+import requests.adapters
 import os
 import time
+import uuid
 import lib.amazonmws.amazonmws as amz_mws
 
-from worker import app
-from celery.five import monotonic
+from worker import app, Throttled
+from .batching import Coalescer
+from .cache import ResponseCache
+from .limiter import QuotaLimiter
 
 
 ########################################################################################################################
@@ -58,25 +62,71 @@ mws_priority_limits = {
 }
 
 
+# Published instead of a response when a lease holder is throttled, followed by the countdown. Responses are XML, so
+# they can't start with it.
+THROTTLED_MARKER = 'throttled:'
+
+
+########################################################################################################################
+
+
+http_pool_size = int(os.environ.get('MWS_HTTP_POOL_SIZE', 10))
+http_timeout = (
+    float(os.environ.get('MWS_HTTP_CONNECT_TIMEOUT', 5)),
+    float(os.environ.get('MWS_HTTP_READ_TIMEOUT', 30))
+)
+
+_sessions = {}
+_api_clients = {}
+
+
+def get_session():
+    """Return the pooled HTTP session for the current process. Sessions are created lazily, and never shared across a
+    fork(), so each worker process gets its own keep-alive connections."""
+    pid = os.getpid()
+    if pid not in _sessions:
+        _sessions.clear()
+        _api_clients.clear()
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=http_pool_size, pool_maxsize=http_pool_size)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _sessions[pid] = session
+
+    return _sessions[pid]
+
+
 ########################################################################################################################
 
 
 class MWSTask(app.Task):
     """Common behaviors for all MWS API calls."""
     cache_ttl = 30
+    stale_ttl = 0
+    refresh_priority = 9
     default_retry_delay = 5
     soft_time_limit = 30
     pending_expires = 200
     restore_rate_adjust = 0
     wait_adjust = 0
+    lease_timeout = 30
+    throttle_mode = os.environ.get('MWS_THROTTLE_MODE', 'sleep')
+    max_sleep = 1
+    batch_param = None
+    batch_size = 20
+    batch_window = 0.25
+    fresh_for = 0
 
     @staticmethod
     def _use_requests(method, **kwargs):
-        """Adapter function that lets the amazonmws library use requests."""
+        """Adapter function that lets the amazonmws library use requests, through the process's pooled session."""
+        kwargs.setdefault('timeout', http_timeout)
+
         if method == 'POST':
-            return requests.post(**kwargs)
+            return get_session().post(**kwargs)
         elif method == 'GET':
-            return requests.get(**kwargs)
+            return get_session().get(**kwargs)
         else:
             raise ValueError('Unsupported HTTP method: ' + method)
 
@@ -85,6 +135,8 @@ class MWSTask(app.Task):
         # Set up database connections here
         self.api = None
         self.redis = redis.from_url(os.environ['REDIS_URL'])
+        self.limiter = QuotaLimiter(self.redis)
+        self.cache = ResponseCache(self.redis)
         self._credentials = {
             'access_key': os.environ.get('MWS_ACCESS_KEY', 'test_access_key'),
             'secret_key': os.environ.get('MWS_SECRET_KEY', 'test_secret_key'),
@@ -108,14 +160,24 @@ class MWSTask(app.Task):
         self._api_name, self._action_name = self.name.split('.')[-2:]
         self._api_name = 'ProductAdvertising' if self._api_name == 'product_adv' else self._api_name.capitalize()
 
-        # Check the cache
-        if kwargs.pop('use_cache', True):
-            self._cache_key = self.build_cache_key(*args, **kwargs)
-            self._cached_value = self.get_cached_value()
+        # Check the cache. Stale values are returned right away, and refreshed in the background.
+        coalesce = kwargs.pop('coalesce', False) and self.batch_param in kwargs
+        use_cache = kwargs.pop('use_cache', True)
+        self._cache_key = self.build_cache_key(*args, **kwargs)
+        self._cached_value = None
+        self.fresh_for = self.cache_ttl
+        if use_cache:
+            self._cached_value, fresh_for = self.get_cache_entry()
+            if self._cached_value is not None:
+                self.fresh_for = fresh_for
+                if not fresh_for:
+                    self.refresh_cache(*args, **kwargs)
 
         if self._cached_value is not None:
-            print(f'Using cached value {self._cache_key} cache_ttl: {self.cache_ttl}')
+            print(f'Using cached value {self._cache_key} cache_ttl: {self.cache_ttl} stats: {self.cache.stats}')
             self.run = self.return_cached_value
+        elif coalesce:
+            self.run = self.coalesce_api_call
         else:
             self.run = self.make_api_call
 
@@ -134,110 +196,152 @@ class MWSTask(app.Task):
     def return_cached_value(self, *args, **kwargs):
         return self._cached_value
 
+    @property
+    def usage_key(self):
+        """The key of the quota shared by every call to this operation."""
+        return self.name + '_usage'
+
     def load_usage(self):
-        """Load usage for this operation type, and increment the pending counter for this operation."""
-        usage_key = self.name + '_usage'
-
-        now = monotonic()
-        restore_rate = self._limits['restore_rate']
-
-        # The script below restores the quota level based on the elapsed time and the restore rate
-        # Call like so: EVAL script 1 usage_key current_time restore_rate
-        script = f"""
-        local usage = redis.call('HMGET', '{usage_key}', 'quota_level', 'pending', 'last_request')
-        local quota_level = true and tonumber(usage[1]) or 0
-        local pending = true and tonumber(usage[2]) or 0
-        local last_request = true and tonumber(usage[3]) or 0
-        local restored = 0
-        
-        if last_request > 0 then
-            restored = ({now} - last_request) / {restore_rate}
-            quota_level = math.max(quota_level - restored, 0)
-            redis.call('HSET', '{usage_key}', 'quota_level', quota_level)
-        end
-        
-        redis.call('HINCRBY', '{usage_key}', 'pending', 1)
-        redis.call('EXPIRE', '{usage_key}', {self.pending_expires})
-        
-        return {{tostring(quota_level), pending, tostring(last_request), tostring(restored)}}
-        """
-
-        values = self.redis.eval(script, 0)
-
-        usage = {
-            'quota_level': float(values[0]),
-            'pending': int(values[1]),
-            'last_request': float(values[2])
-        }
+        """Reserve quota for this operation type, and store the resulting usage stats."""
+        usage_key = self.usage_key
+
+        self._usage = self.limiter.reserve(
+            usage_key,
+            self._limits['quota_max'],
+            self._limits['restore_rate'],
+            expires=self.pending_expires
+        )
 
-        self._usage = usage
         print(f"{usage_key}: "
-              f"quota_level={usage['quota_level']} "
-              f"pending={usage['pending']} "
-              f"last_request={usage['last_request']} "
-              f"now={now} "
-              f"restored={values[-1]}")
+              f"quota_level={self._usage['quota_level']} "
+              f"wait={self._usage['wait']}")
 
     def calculate_wait(self):
         """Calculate how long to sleep() before making the API call."""
-        quota_max = self._limits['quota_max']
-        restore_rate = self._limits['restore_rate']
-        quota_level = self._usage['quota_level']
-        pending = self._usage['pending']
-
-        return max((quota_level + pending + 1 - quota_max), 0) * restore_rate
+        return self._usage['wait']
 
     def make_api_call(self, *args, **kwargs):
-        """Make the api call, save the value to the cache, and update usage statistics."""
+        """Make the api call and save the value to the cache. Concurrent calls with the same cache key are made only
+        once: the first caller takes a lease and makes the call, and the others wait for its result."""
+        if not self._cache_key:
+            return self.call_api(*args, **kwargs)
+
+        lease_key = self._cache_key + '_lease'
+        lease_token = uuid.uuid4().hex
+        deadline = time.time() + self.lease_timeout * 2
+
+        while time.time() < deadline:
+            if self.redis.set(lease_key, lease_token, nx=True, ex=self.lease_timeout):
+                try:
+                    return_value = self.call_api(*args, **kwargs)
+                    self.save_to_cache(return_value)
+                    self.redis.publish(lease_key, return_value)
+                    return return_value
+                except Throttled as e:
+                    # The others would be throttled too, so they back off instead of calling the API themselves
+                    self.redis.publish(lease_key, f'{THROTTLED_MARKER}{e.countdown}')
+                    raise e
+                except Exception as e:
+                    self.redis.publish(lease_key, '')
+                    raise e
+                finally:
+                    # If the lease expired while we were working, it may belong to someone else by now
+                    self.limiter.release(lease_key, lease_token)
+
+            return_value = self.wait_for_lease(lease_key, deadline)
+            if return_value is not None:
+                return return_value
+
+        raise TimeoutError(f'Timed out waiting for {lease_key}')
+
+    def wait_for_lease(self, lease_key, deadline):
+        """Wait for the holder of lease_key to publish its result. Returns None if the call failed, or if the lease
+        expired without a result (e.g., because the worker holding it crashed). Raises Throttled if the holder was
+        throttled."""
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(lease_key)
+        try:
+            # The call may have finished before we subscribed
+            return_value = self.get_cached_value()
+
+            while return_value is None and time.time() < deadline and self.redis.exists(lease_key):
+                message = pubsub.get_message(timeout=1)
+                if message is not None:
+                    data = message['data'].decode()
+                    if data.startswith(THROTTLED_MARKER):
+                        raise Throttled(float(data[len(THROTTLED_MARKER):]))
+
+                    print(f'Using result of concurrent call {self._cache_key}')
+                    return data or None
+
+            return return_value if return_value is not None else self.get_cached_value()
+        finally:
+            pubsub.close()
+
+    def coalesce_api_call(self, *args, **kwargs):
+        """Combine this call with concurrent calls to the same action, and make a single batched API call. Only calls
+        whose arguments are identical apart from batch_param are combined."""
+        batch_value = kwargs.pop(self.batch_param)
+        is_list = not isinstance(batch_value, str)
+        items = list(batch_value) if is_list else [i.strip() for i in batch_value.split(',')]
+
+        group_kwargs = {k: v for k, v in kwargs.items() if k != 'priority'}
+        group = hashlib.md5(
+            json.dumps({'args': args, 'kwargs': group_kwargs}, sort_keys=True).encode()
+        ).hexdigest()
+
+        coalescer = Coalescer(
+            self.redis,
+            f'{self.name}_batch_{group}',
+            batch_size=self.batch_size,
+            batch_window=self.batch_window,
+            lease_timeout=self.soft_time_limit * 2
+        )
+
+        # In 'reschedule' mode, a throttled leader raises Throttled in every caller in the batch, so none of them
+        # holds on to its worker while waiting for quota
+        def call(merged):
+            return self.call_api(*args, **kwargs, **{self.batch_param: merged if is_list else ','.join(merged)})
+
+        return_value = coalescer.submit(items, call)
+        self.save_to_cache(return_value)
+        return return_value
+
+    def call_api(self, *args, **kwargs):
+        """Wait for quota and make the API call."""
         priority = kwargs.pop('priority', 0)
 
         self.load_api()
         self.load_throttle_limits(priority)
-        self.load_usage()
+        self.wait_for_quota()
+        return getattr(self.api, self._action_name)(*args, **kwargs).text
+
+    def wait_for_quota(self):
+        """Reserve quota for this call and wait until it can be used. In 'reschedule' mode, waits longer than max_sleep
+        raise Throttled instead, so the task can be requeued. The reservation is kept under the operation's quota and
+        the ID of the task that will be requeued, so the requeued call uses its original slot instead of reserving a
+        new one. Reservation times are measured with the Redis server clock, like the quota itself."""
+        worker_task = app.current_worker_task
+        task_id = worker_task.request.id if worker_task is not None else self.request.id
+        reservation_key = f'{self.usage_key}_reservation_{task_id}' if task_id else None
+        reserved_at = self.redis.get(reservation_key) if reservation_key else None
+
+        if reserved_at is not None:
+            wait = max(float(reserved_at) - self.limiter.now(), 0)
+        else:
+            self.load_usage()
+            wait = self.calculate_wait() + self.wait_adjust
 
-        wait = self.calculate_wait()
         print(f'Wait time: {wait}')
-        time.sleep(wait + self.wait_adjust)
-        try:
-            return_value = getattr(self.api, self._action_name)(*args, **kwargs).text
-        except Exception as e:
-            self.save_usage()
-            raise e
+        if self.throttle_mode == 'reschedule' and wait > self.max_sleep:
+            if reservation_key and reserved_at is None:
+                self.redis.set(reservation_key, self._usage['now'] + wait, ex=int(wait) + self.pending_expires)
+            raise Throttled(wait)
 
-        self.save_usage()
-        self.save_to_cache(return_value)
-        return return_value
+        if reserved_at is not None:
+            self.redis.delete(reservation_key)
 
-    def save_usage(self):
-        """Update the usage stats in the cache."""
-        usage_key = self.name + '_usage'
-
-        # Because Lua can't do floats, we're going to convert everything to milliseconds. WTF Lua...
-        now = monotonic()
-        restore_rate = self._limits['restore_rate']
-
-        # The script below restores the quota level based on the elapsed time and the restore rate
-        # Call like so: EVAL script 1 usage_key current_time restore_rate
-        script = f"""
-                local usage = redis.call('HMGET', '{usage_key}', 'quota_level', 'last_request')
-                local quota_level = true and tonumber(usage[1]) or 0
-                local last_request = true and tonumber(usage[2]) or 0
-                local restored = 0
-                
-                if last_request > 0 then
-                    local restored = ({now} - last_request) / {restore_rate}
-                    quota_level = math.max(quota_level - restored, 0)
-                    redis.call('HSET', '{usage_key}', 'quota_level', quota_level + 1)
-                end
-                
-                redis.call('HINCRBY', '{usage_key}', 'pending', -1)
-                redis.call('HSET', '{usage_key}', 'last_request', {now})
-                
-                return {{tostring(restored), tostring(last_request)}}
-                """
-
-        values = self.redis.eval(script, 0)
-        print(f'restored={values[0]} last_request={values[1]}')
+        time.sleep(wait)
 
     def load_throttle_limits(self, priority):
         """Load custom throttle limits based on a task's name and priority."""
@@ -268,37 +372,80 @@ class MWSTask(app.Task):
         print(f'{self.name} throttle limits: {self._limits}')
 
     def load_api(self):
-        """Loads the correct API object from amz_mws, based on the module name of the current task."""
-        self.api = getattr(amz_mws, self._api_name)(
-            **self._pa_credentials if self._api_name == 'ProductAdvertising' else self._credentials,
-            make_request=self._use_requests
-        )
+        """Loads the correct API object from amz_mws, based on the module name of the current task. API objects are
+        created once per process for each API and set of credentials."""
+        credentials = self._pa_credentials if self._api_name == 'ProductAdvertising' else self._credentials
+        client_key = (self._api_name, *sorted(credentials.items()))
+
+        if client_key not in _api_clients or os.getpid() not in _sessions:
+            get_session()
+            _api_clients[client_key] = getattr(amz_mws, self._api_name)(
+                **credentials,
+                make_request=self._use_requests
+            )
+
+        self.api = _api_clients[client_key]
+
+    @staticmethod
+    def build_signature(*args, **kwargs):
+        """Return a hash of the call signature, ignoring the priority parameter."""
+        kwargs.pop('priority', None)
+
+        return hashlib.md5(
+            json.dumps({'args': args, 'kwargs': kwargs}).encode()
+        ).hexdigest()
 
     def build_cache_key(self, *args, **kwargs):
         """Build a key to store/retrieve cache values in redis. The key signature is build from the class name and
         the call signature."""
         if not self.cache_ttl:
             return None
-        else:
-            kwargs.pop('priority', None)
 
-            sig = hashlib.md5(
-                json.dumps({'args': args, 'kwargs': kwargs}).encode()
-            ).hexdigest()
+        # The order of the items in a batch doesn't change the response
+        batch_value = kwargs.get(self.batch_param)
+        if isinstance(batch_value, str):
+            kwargs[self.batch_param] = ','.join(sorted(item.strip() for item in batch_value.split(',')))
+        elif isinstance(batch_value, list):
+            kwargs[self.batch_param] = sorted(batch_value, key=json.dumps)
+
+        return f'{self.name}_{self.build_signature(*args, **kwargs)}'
 
-            return f'{self.name}_{sig}'
+    def get_cache_entry(self):
+        """Return a (value, fresh_for) tuple for the current cache key, where fresh_for is the number of seconds the
+        value stays fresh. Values older than cache_ttl, but still within the stale_ttl grace window, are returned with
+        fresh_for=0. If there is no cached value, returns (None, 0)."""
+        if not self.cache_ttl or not self._cache_key:
+            return None, 0
+
+        entry = self.cache.get_entry(self._cache_key, self.stale_ttl)
+        if entry is None:
+            return None, 0
+
+        expires_at, value = entry
+        return value, int(max(expires_at - self.stale_ttl - time.time(), 0))
 
     def get_cached_value(self):
-        """Return the value in the cache corresponding to the given args and kwargs, or None."""
-        if not self.cache_ttl or not self.redis.exists(self._cache_key):
-            return None
-        else:
-            return self.redis.get(self._cache_key).decode()
+        """Return the fresh value in the cache corresponding to the given args and kwargs, or None."""
+        value, fresh_for = self.get_cache_entry()
+        return value if fresh_for else None
 
     def save_to_cache(self, value):
-        """Save the value to the cache."""
-        if self.cache_ttl:
-            self.redis.set(self._cache_key, value, ex=self.cache_ttl)
+        """Save the value to the cache. Values are kept for stale_ttl seconds past their cache_ttl."""
+        if self.cache_ttl and self._cache_key:
+            self.cache.set(self._cache_key, value, self.cache_ttl + self.stale_ttl)
+
+    def refresh_cache(self, *args, **kwargs):
+        """Queue a low-priority call that refreshes the current cache entry. At most one refresh is queued per key."""
+        refresh_key = self._cache_key + '_refresh'
+        if not self.redis.set(refresh_key, 1, nx=True, ex=self.lease_timeout * 2):
+            return
+
+        print(f'Refreshing stale value {self._cache_key}')
+        self.apply_async(
+            args=args,
+            kwargs={**kwargs, 'use_cache': False, 'priority': 0},
+            priority=self.refresh_priority
+        )
 
     def after_return(self, status, retval, task_id, args, kwargs, einfo):
         """Clean up."""
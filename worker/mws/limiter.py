@@ -0,0 +1,90 @@
+########################################################################################################################
+
+
+# Restores the quota level based on the time elapsed since the last reservation, then reserves one request.
+# Quota levels may go above quota_max; the excess is the backlog of reservations still waiting for their turn.
+# Uses the Redis server clock, so every worker agrees on the time no matter which host it runs on.
+#
+# KEYS[1]: usage key
+# ARGV[1]: quota_max
+# ARGV[2]: restore_rate, in seconds per request
+# ARGV[3]: minimum expiry for the usage key, in seconds; it is kept at least until the backlog has been restored
+#
+# Returns {wait, quota_level, now} as strings, because Redis truncates Lua numbers to integers.
+RESERVE_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local quota_max = tonumber(ARGV[1])
+local restore_rate = tonumber(ARGV[2])
+
+local usage = redis.call('HMGET', KEYS[1], 'quota_level', 'last_request')
+local quota_level = tonumber(usage[1]) or 0
+local last_request = tonumber(usage[2]) or now
+
+if restore_rate > 0 then
+    quota_level = math.max(quota_level - (now - last_request) / restore_rate, 0)
+else
+    quota_level = 0
+end
+
+local wait = math.max(quota_level + 1 - quota_max, 0) * restore_rate
+quota_level = quota_level + 1
+
+redis.call('HSET', KEYS[1], 'quota_level', tostring(quota_level), 'last_request', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.max(math.ceil(quota_level * restore_rate), tonumber(ARGV[3])))
+
+return {tostring(wait), tostring(quota_level), tostring(now)}
+"""
+
+
+# Deletes a lease, but only if it still holds the caller's token. A lease that expired and was taken by another worker
+# is left alone.
+#
+# KEYS[1]: lease key
+# ARGV[1]: the token stored when the lease was taken
+#
+# Returns 1 if the lease was released, 0 otherwise.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+########################################################################################################################
+
+
+class QuotaLimiter:
+    """A token bucket rate limiter stored in Redis, modeled after the MWS throttling scheme: each request uses one
+    unit of quota, up to quota_max, and one unit is restored every restore_rate seconds.
+
+    The script is registered once, and called by SHA with the key and limits as parameters, so Redis only ever caches
+    one script no matter how many actions or priorities are in use."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._reserve = redis.register_script(RESERVE_SCRIPT)
+        self._release = redis.register_script(RELEASE_SCRIPT)
+
+    def reserve(self, key, quota_max, restore_rate, expires=200):
+        """Reserve one request, in a single round trip. Returns a dictionary with the number of seconds to wait before
+        making the request, the quota level after the reservation, and the server time it was made at."""
+        wait, quota_level, now = self._reserve(keys=[key], args=[quota_max, restore_rate, expires])
+
+        return {
+            'wait': float(wait),
+            'quota_level': float(quota_level),
+            'now': float(now)
+        }
+
+    def now(self):
+        """Return the Redis server time, the clock every reservation is measured against."""
+        seconds, microseconds = self.redis.time()
+        return seconds + microseconds / 1000000
+
+    def release(self, key, token):
+        """Delete the lease at key if it still holds token. Returns True if it did."""
+        return bool(self._release(keys=[key], args=[token]))
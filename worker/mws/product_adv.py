@@ -4,7 +4,7 @@ from .common import *
 ########################################################################################################################
 
 
-@app.task(base=MWSTask, bind=True, cache_ttl=60*5)
+@app.task(base=MWSTask, bind=True, cache_ttl=60*5, stale_ttl=60*5, batch_param='ItemId', batch_size=10)
 class ItemLookup(MWSTask):
     pass
 
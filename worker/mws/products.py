@@ -14,11 +14,11 @@ class ListMatchingProducts(MWSTask):
     pass
 
 
-@app.task(base=MWSTask, bind=True, cache_ttl=60*30)
+@app.task(base=MWSTask, bind=True, cache_ttl=60*30, batch_param='FeesEstimateRequestList', batch_size=20)
 class GetMyFeesEstimate(MWSTask):
     pass
 
 
-@app.task(base=MWSTask, bind=True, cache_ttl=60*5)
+@app.task(base=MWSTask, bind=True, cache_ttl=60*5, stale_ttl=60*5, batch_param='ASINList', batch_size=20)
 class GetCompetitivePricingForASIN(MWSTask):
     pass
@@ -1,46 +1,222 @@
 import os
+import time
+import redis
 import pymongo
+from celery import signals
+from celery.utils.log import get_task_logger
 from worker import app
 
 
+logger = get_task_logger(__name__)
+
+
+########################################################################################################################
+
+
+mongo_pool_size = int(os.environ.get('MONGODB_POOL_SIZE', 10))
+
+_mongo_clients = {}
+
+
+def get_mongo_client():
+    """Return the MongoClient for the current process, which is shared by every ops task. Clients are created lazily,
+    and never shared across a fork(), since pymongo's connection pools aren't fork-safe."""
+    pid = os.getpid()
+    if pid not in _mongo_clients:
+        _mongo_clients.clear()
+        _mongo_clients[pid] = pymongo.MongoClient(os.environ['MONGODB_URI'], maxPoolSize=mongo_pool_size)
+
+    return _mongo_clients[pid]
+
+
+def get_db(client=None):
+    """Return the MongoDB database named in MONGODB_URI, from client or the current process's client."""
+    db_name = os.environ['MONGODB_URI'].split('/')[-1]
+    return (client if client is not None else get_mongo_client())[db_name]
+
+
+@signals.worker_process_shutdown.connect
+@signals.worker_shutdown.connect
+def close_mongo_client(**kwargs):
+    """Close the current process's MongoClient when the worker (or one of its pool processes) shuts down."""
+    client = _mongo_clients.pop(os.getpid(), None)
+    if client is not None:
+        client.close()
+
+
+########################################################################################################################
+
+
+# Product fields that opportunity metrics are calculated from
+opportunity_fields = ('price', 'market_fees', 'quantity', 'ship_rate')
+
+# Set of product IDs whose opportunities need to be recalculated
+dirty_products_key = 'ops.dirty_products'
+
+
+def changed_fields(before, after, fields=opportunity_fields):
+    """Return the fields whose values differ between two versions of a document. Fields missing from after are
+    ignored, since they weren't updated."""
+    return [field for field in fields if field in after and before.get(field) != after[field]]
+
+
+########################################################################################################################
+
+
+class VendorCache:
+    """A process-wide cache of the vendors collection, by ID and by name.
+
+    The collection is small, so it is loaded all at once: when a worker process starts, and again whenever ttl seconds
+    have passed. Each process also subscribes to a Redis channel, and when a vendor is changed through publish_change(),
+    every process drops its copy right away instead of waiting for the TTL. Nothing is shared across a fork().
+
+    Lookups for vendors that don't exist are cached too, until the next reload, so that products with a missing vendor
+    don't cause a query each."""
+    channel = 'ops.vendors_changed'
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._by_id = {}
+        self._by_name = {}
+        self._missing_ids = set()
+        self._missing_names = set()
+        self._expires = 0
+        self._pid = None
+        self._listener = None
+
+    def prewarm(self, db):
+        """Subscribe to changes if this process hasn't yet, and reload the cache if it has expired."""
+        if self._pid != os.getpid():
+            self._pid, self._listener, self._expires = os.getpid(), None, 0
+            self.subscribe()
+
+        if time.time() >= self._expires:
+            self.load(db)
+
+    def load(self, db):
+        vendors = list(db.vendors.find())
+        self._by_id = {vendor['_id']: vendor for vendor in vendors}
+        self._by_name = {vendor['name']: vendor for vendor in vendors}
+        self._missing_ids, self._missing_names = set(), set()
+        self._expires = time.time() + self.ttl
+
+    def _add(self, vendor):
+        self._by_id[vendor['_id']] = vendor
+        self._by_name[vendor['name']] = vendor
+        self._missing_ids.discard(vendor['_id'])
+        self._missing_names.discard(vendor['name'])
+
+    def get(self, db, vendor_id):
+        """Return the vendor document with the given ID, or None."""
+        self.prewarm(db)
+        vendor = self._by_id.get(vendor_id)
+        if vendor is None and vendor_id not in self._missing_ids:
+            vendor = db.vendors.find_one({'_id': vendor_id})
+            if vendor is not None:
+                self._add(vendor)
+            else:
+                self._missing_ids.add(vendor_id)
+
+        return vendor
+
+    def get_by_name(self, db, name):
+        """Return the vendor document with the given name, or None."""
+        self.prewarm(db)
+        vendor = self._by_name.get(name)
+        if vendor is None and name not in self._missing_names:
+            vendor = db.vendors.find_one({'name': name})
+            if vendor is not None:
+                self._add(vendor)
+            else:
+                self._missing_names.add(name)
+
+        return vendor
+
+    def get_or_create_id(self, db, name):
+        """Return the ID of the vendor with a given name. If none exists, one will be created."""
+        vendor = self.get_by_name(db, name)
+        if vendor is None:
+            vendor = db.vendors.find_one_and_update(
+                filter={'name': name},
+                update={'$set': {'name': name}},
+                upsert=True,
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+            self._add(vendor)
+
+        return vendor['_id']
+
+    def invalidate(self):
+        self._expires = 0
+
+    def subscribe(self):
+        """Invalidate the cache whenever a change is published, from a background thread."""
+        try:
+            pubsub = redis.from_url(os.environ['REDIS_URL']).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: lambda message: self.invalidate()})
+            self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except (KeyError, redis.RedisError) as e:
+            logger.warning(f'Vendor cache changes will only be picked up every {self.ttl} seconds: {e}')
+
+    def unsubscribe(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+        self._listener = None
+
+    def publish_change(self, redis_client, vendor_id):
+        """Tell every worker process that a vendor has changed."""
+        self.invalidate()
+        redis_client.publish(self.channel, str(vendor_id))
+
+
+vendor_cache = VendorCache(int(os.environ.get('OPS_VENDOR_CACHE_TTL', 300)))
+
+
+@signals.worker_process_init.connect
+def prewarm_vendor_cache(**kwargs):
+    """Load the vendors when a worker process starts, so the first tasks don't have to."""
+    try:
+        vendor_cache.prewarm(get_db())
+    except pymongo.errors.PyMongoError as e:
+        logger.warning(f'Could not preload the vendor cache: {e}')
+
+
+@signals.worker_process_shutdown.connect
+@signals.worker_shutdown.connect
+def stop_vendor_cache(**kwargs):
+    vendor_cache.unsubscribe()
+
+
 ########################################################################################################################
 
 
 class OpsTask(app.Task):
     """Provides common behaviours and resources for the ops group of tasks."""
+    bulk_batch_size = int(os.environ.get('OPS_BULK_BATCH_SIZE', 500))
 
     def __init__(self):
         """Initialize the task object."""
-        self._db = None
-        self._vendor_id_cache = {}
+        self._redis = None
 
     @property
     def db(self):
-        """The MongoDB database."""
-        if self._db is None:
-            uri = os.environ['MONGODB_URI']
-            db_name = uri.split('/')[-1]
-            self._db = pymongo.MongoClient(uri)[db_name]
+        """The MongoDB database, using the connection pool of the current worker process."""
+        return get_db()
 
-        return self._db
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = redis.from_url(os.environ['REDIS_URL'])
+
+        return self._redis
 
-    def after_return(self, status, retval, task_id, args, kwargs, einfo):
-        """Close the database connection when the task finishes."""
-        if self._db is not None:
-            self._db.client.close()
-            self._db = None
+    def mark_dirty(self, product_ids):
+        """Queue the opportunities of the given products to be recalculated by the next recompute_dirty_opportunities
+        run. Marking a product more than once before then has no further effect."""
+        product_ids = [str(product_id) for product_id in product_ids]
+        if product_ids:
+            self.redis.sadd(dirty_products_key, *product_ids)
 
     def get_or_create_vendor(self, name):
         """Return the ID of the vendor with a given name. If none exists, one will be created."""
-        if name not in self._vendor_id_cache:
-            vendors = self.db['vendors']
-            self._vendor_id_cache[name] = vendors.find_one_and_update(
-                filter={'name': name},
-                update={'$set': {'name': name}},
-                projection={'_id': 1},
-                upsert=True,
-                return_document=pymongo.ReturnDocument.AFTER
-            )['_id']
-
-        return self._vendor_id_cache[name]
-
+        return vendor_cache.get_or_create_id(self.db, name)
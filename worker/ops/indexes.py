@@ -0,0 +1,132 @@
+"""Declares the indexes the ops tasks rely on, creates them when the worker starts, and checks that the hot-path
+queries use them.
+
+Create the indexes and check the query plans from the worker directory:
+
+    python -m ops.indexes --ensure --check
+"""
+import argparse
+import sys
+from bson import ObjectId
+from celery.utils.log import get_task_logger
+from .common import *
+
+
+logger = get_task_logger(__name__)
+
+
+########################################################################################################################
+
+
+# Collection -> list of (keys, options)
+indexes = {
+    'products': [
+        ([('vendor', pymongo.ASCENDING), ('sku', pymongo.ASCENDING)], {'unique': True})
+    ],
+
+    'opportunities': [
+        ([('market_listing', pymongo.ASCENDING), ('supplier_listing', pymongo.ASCENDING)], {'unique': True}),
+        ([('supplier_listing', pymongo.ASCENDING)], {})
+    ],
+
+    'vendors': [
+        ([('name', pymongo.ASCENDING)], {'unique': True})
+    ]
+}
+
+
+# Collection -> filters shaped like the ones the ops tasks use
+hot_queries = {
+    'products': [
+        {'vendor': ObjectId(), 'sku': 'B000000000'},
+        {'vendor': ObjectId(), 'sku': {'$in': ['B000000000', 'B000000001']}},
+        {'vendor': ObjectId()}
+    ],
+
+    'opportunities': [
+        {'market_listing': ObjectId(), 'supplier_listing': ObjectId()},
+        {'market_listing': {'$in': [ObjectId(), ObjectId()]}, 'supplier_listing': ObjectId()},
+        {'market_listing': ObjectId()},
+        {'supplier_listing': ObjectId()}
+    ],
+
+    'vendors': [
+        {'name': 'Amazon'}
+    ]
+}
+
+
+########################################################################################################################
+
+
+def ensure_indexes(db):
+    """Create any missing indexes. Existing indexes are left alone, so this is safe to run as often as needed. Returns
+    the number of indexes that could not be created (e.g. because existing documents violate a unique index)."""
+    failed = 0
+    for collection, specs in indexes.items():
+        for keys, options in specs:
+            try:
+                db[collection].create_index(keys, **options)
+            except pymongo.errors.PyMongoError as e:
+                failed += 1
+                logger.error(f'Could not create index {keys} on {collection}: {e}')
+
+    return failed
+
+
+def plan_stages(plan):
+    """Yield the stage names in a query plan, and in all of its input stages."""
+    yield plan.get('stage')
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            yield from plan_stages(child)
+
+
+def check_query_plans(db):
+    """Explain each hot-path query, and return a list of (collection, filter) for the ones that scan the whole
+    collection."""
+    scans = []
+    for collection, filters in hot_queries.items():
+        for query in filters:
+            plan = db[collection].find(query).explain()['queryPlanner']['winningPlan']
+            if 'COLLSCAN' in plan_stages(plan):
+                scans.append((collection, query))
+
+    return scans
+
+
+@signals.worker_init.connect
+def ensure_indexes_on_startup(**kwargs):
+    """Create the indexes when the worker starts. Uses its own client, so nothing is left open across the fork."""
+    client = pymongo.MongoClient(os.environ['MONGODB_URI'])
+    try:
+        ensure_indexes(get_db(client))
+    except pymongo.errors.PyMongoError as e:
+        logger.error(f'Could not ensure indexes: {e}')
+    finally:
+        client.close()
+
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ensure', action='store_true', help='create any missing indexes')
+    parser.add_argument('--check', action='store_true', help='fail if a hot-path query scans a whole collection')
+    args = parser.parse_args()
+
+    db = get_db()
+    status = 0
+
+    if args.ensure and ensure_indexes(db):
+        status = 1
+
+    if args.check:
+        for collection, query in check_query_plans(db):
+            print(f'COLLSCAN: {collection}.find({query})')
+            status = 1
+        if not status:
+            print('All hot-path queries use an index.')
+
+    sys.exit(status)
@@ -1,7 +1,10 @@
-import collections
+import itertools
+import collections.abc
 from celery import chain, group, chord
 from celery.utils.log import get_task_logger
 from bson import ObjectId
+import mws.products
+import mws.product_adv
 from .common import *
 from parsed.products import *
 from parsed.product_adv import *
@@ -17,71 +20,162 @@ logger = get_task_logger(__name__)
 def find_amazon_matches(self, product_id, brand=None, model=None):
     """Find matching products in Amazon's catalog, import them, and create corresponding opportunities."""
 
-    if None not in [brand, model]:
-        query_string = f'{brand} {model}'
-    else:
+    if None in [brand, model]:
         raise NotImplementedError
 
-    matches = ListMatchingProducts(query=query_string)
+    listings = import_product_matches(self, product_id, brand, model)
+    update_listings_in_batches(listings, self.bulk_batch_size)
 
-    amz_id = self.get_or_create_vendor('Amazon')
-    collection = self.db.products
-    for match in matches:
-        # Insert/update the Amazon product
-        match['vendor'] = amz_id
-        match = collection.find_one_and_update(
-            filter={
-                'vendor': amz_id,
-                'sku': match['sku']
-            },
-            update={
-                '$set': {**match}
-            },
-            upsert=True,
-            return_document=pymongo.ReturnDocument.AFTER
-        )
 
-        # Insert/update the opportunity relationship
-        match_id = match['_id']
-        opportunity = {
-            'market_listing': match_id,
-            'supplier_listing': product_id
-        }
-        opportunity = collection.find_one_and_update(
-            filter={**opportunity},
-            update={
-                '$set': {**opportunity}
-            },
-            upsert=True,
-            return_document=pymongo.ReturnDocument.AFTER
-        )
+@app.task(base=OpsTask, bind=True)
+def find_amazon_matches_many(self, products):
+    """Like find_amazon_matches(), for many products at once. products is a list of dictionaries with product_id,
+    brand and model keys; products without a brand or model are skipped.
 
-        # Follow-up tasks:
-        asin = match['sku']
+    Each product's matches are found by its own find_product_matches task, so a throttled or failed lookup is retried
+    or fails on its own, without repeating the others. Once they are all done, the matches of all the products are
+    updated together, so products that share matches only cause one update per match."""
+    header = [
+        find_product_matches.s(product['product_id'], product['brand'], product['model'])
+        for product in products if product.get('brand') and product.get('model')
+    ]
 
-        chain(
-            chord(
-                ItemLookup.s(asin),
-                GetCompetitivePricingForASIN.s(asin)
-            )(update_amazon_listing.s(str(match_id))),
-            update_fba_fees.s(),
-            update_opportunities.s()
-        ).apply_async()
+    if header:
+        chord(header, update_matched_listings.s()).apply_async()
 
 
 @app.task(base=OpsTask, bind=True)
-def update_amazon_listing(self, data, product_id):
-    """Updates a product using various sources of data."""
-    collection = self.db.products
+def find_product_matches(self, product_id, brand, model):
+    """Find and import one product's matches, for find_amazon_matches_many(). Returns a dictionary of ASIN -> Amazon
+    product ID. Error responses are logged and return no matches, so they don't hold up the other products."""
+    try:
+        listings = import_product_matches(self, product_id, brand, model)
+    except AmzResponseError as e:
+        logger.error(f'Could not find matches for {product_id}: {e}')
+        return {}
 
-    product_id = ObjectId(product_id)
-    product = collection.find_one({'_id': product_id}, projection={'sku': 1})
+    return {asin: str(match_id) for asin, match_id in listings.items()}
+
+
+@app.task(base=OpsTask, bind=True)
+def update_matched_listings(self, results):
+    """Update the listings of every find_product_matches() result, in batches."""
+    listings = {}
+    for result in results:
+        listings.update(result)
+
+    update_listings_in_batches(listings, self.bulk_batch_size)
+
+
+def import_product_matches(task, product_id, brand, model):
+    """Find a product's matches in Amazon's catalog, and import them along with their opportunities. Returns a
+    dictionary of ASIN -> Amazon product ID."""
+    amz_id = task.get_or_create_vendor('Amazon')
+    supplier_id = ObjectId(product_id)
+    listings = {}
+
+    # Matches are parsed and written in batches, as they are processed
+    matches = stream_matching_products(query=f'{brand} {model}')
+    while True:
+        batch = list(itertools.islice(matches, task.bulk_batch_size))
+        if not batch:
+            break
+
+        for asin, match_id, _ in import_amazon_matches(task, amz_id, supplier_id, batch):
+            listings[asin] = match_id
+
+    return listings
+
+
+def listing_workflow(listings):
+    """Return a canvas that updates a batch of Amazon listings, given as a dictionary of ASIN -> product ID.
+
+    The header of a single chord looks up and prices all of the ASINs, in as few API calls as the batch size of each
+    action allows; the calls are already full, so they aren't coalesced with others. Its callback updates every
+    listing with one bulk write, and is followed by a single fees update for the listings whose price changed.
+    Opportunities are recalculated through the dirty set."""
+    asins = list(listings)
+    lookup_size = mws.product_adv.ItemLookup.batch_size
+    pricing_size = mws.products.GetCompetitivePricingForASIN.batch_size
+
+    header = [ItemLookup.s(ItemId=','.join(asins[i:i + lookup_size]), coalesce=False)
+              for i in range(0, len(asins), lookup_size)]
+    header += [GetCompetitivePricingForASIN.s(ASINList=asins[i:i + pricing_size], coalesce=False)
+               for i in range(0, len(asins), pricing_size)]
+
+    return chain(
+        chord(header, update_amazon_listings.s([str(listings[asin]) for asin in asins])),
+        update_fba_fees_many.s()
+    )
+
+
+def update_listings_in_batches(listings, batch_size):
+    """Start a listing_workflow() for every batch_size listings."""
+    asins = list(listings)
+    for start in range(0, len(asins), batch_size):
+        listing_workflow({asin: listings[asin] for asin in asins[start:start + batch_size]}).apply_async()
+
+
+def import_amazon_matches(task, amz_id, supplier_id, matches):
+    """Upsert a batch of matched Amazon products and their opportunities, using one bulk write for each collection and
+    one query for each set of IDs. New opportunities are marked dirty through the supplier product. Returns a list of
+    (asin, product ID, opportunity ID) tuples."""
+    db = task.db
+    # If a product is matched more than once, the last match wins
+    matches = {match['sku']: {**match, 'vendor': amz_id} for match in matches}
+    asins = list(matches)
+
+    db.products.bulk_write(
+        [
+            pymongo.UpdateOne(
+                filter={'vendor': amz_id, 'sku': asin},
+                update={'$set': match},
+                upsert=True
+            ) for asin, match in matches.items()
+        ],
+        ordered=False
+    )
+
+    match_ids = {
+        doc['sku']: doc['_id'] for doc in db.products.find(
+            filter={'vendor': amz_id, 'sku': {'$in': asins}},
+            projection={'_id': 1, 'sku': 1}
+        )
+    }
+
+    result = db.opportunities.bulk_write(
+        [
+            pymongo.UpdateOne(
+                filter={'market_listing': match_id, 'supplier_listing': supplier_id},
+                update={'$set': {'market_listing': match_id, 'supplier_listing': supplier_id}},
+                upsert=True
+            ) for match_id in match_ids.values()
+        ],
+        ordered=False
+    )
+
+    # Listings that are already up to date won't be marked dirty when they're updated, so new opportunities would never
+    # be calculated otherwise
+    if result.upserted_count:
+        task.mark_dirty([supplier_id])
+
+    opp_ids = {
+        doc['market_listing']: doc['_id'] for doc in db.opportunities.find(
+            filter={'market_listing': {'$in': list(match_ids.values())}, 'supplier_listing': supplier_id},
+            projection={'_id': 1, 'market_listing': 1}
+        )
+    }
+
+    return [(asin, match_ids[asin], opp_ids[match_ids[asin]]) for asin in asins]
 
-    try: product_asin = product['sku']
-    except AttributeError: raise ValueError(f'Invalid product id: {product_id}')
+
+def merge_listing_data(product, data):
+    """Merge API call results (parsed responses) and raw updates into a product document, in place. API calls that
+    don't contain results for the product are ignored."""
+    product_asin = product['sku']
 
     # Separate the data sources into API call results and raw updates
-    if not isinstance(data, collections.Sequence):
+    if not isinstance(data, collections.abc.Sequence):
         data = [data]
 
     api_calls = [source for source in data if 'action' in source and 'params' in source]
@@ -103,7 +197,12 @@ def update_amazon_listing(self, data, product_id):
                 listing_price = api_call['results'][product_asin].get('listing_price', None)
                 shipping = api_call['results'][product_asin].get('shipping', None)
 
-                product['price'] = landed_price if landed_price is not None else listing_price + shipping
+                # Listings without a New competitive price only have an offer count
+                if landed_price is not None:
+                    product['price'] = landed_price
+                elif listing_price is not None:
+                    product['price'] = listing_price + (shipping or 0)
+
                 product['offers'] = api_call['results'][product_asin].get('offers', None)
             except KeyError:
                 logger.debug(f"API call {call_type} does not contain results for {product_asin}, ignoring...")
@@ -111,7 +210,7 @@ def update_amazon_listing(self, data, product_id):
         elif call_type == 'GetMyFeesEstimate':
             try:
                 product['price'] = api_call['results'][product_asin]['price']
-                product['market_fees'] = api_call['results'][product_asin]['total_fees']
+                product['market_fees'] = api_call['results'][product_asin]['total_fees_estimate']
             except KeyError:
                 logger.debug(f"API call {call_type} does not contain results for {product_asin}, ignoring...")
                 continue
@@ -123,18 +222,101 @@ def update_amazon_listing(self, data, product_id):
     for raw_data in raw_updates:
         product.update(raw_data)
 
-    # Write to the DB
-    collection.find_one_and_update(
-        filter={'_id': product_id},
-        update={'$set': {**product}},
-    )
+    return product
+
+
+def diff_fields(stored, product):
+    """Return the fields of product that are new or different from the stored document."""
+    return {field: value for field, value in product.items() if field not in stored or stored[field] != value}
+
+
+def listing_result(product, changes):
+    """Return the result of update_amazon_listing() for an updated product: its ID, the fields that changed, and the
+    opportunity fields it still doesn't have."""
+    return {
+        'product_id': str(product['_id']),
+        'changed': list(changes),
+        'missing': [field for field in opportunity_fields if product.get(field) is None]
+    }
 
-    return str(product_id)
+
+def needs_fees(listing):
+    """Return True if the fees of an update_amazon_listing() result have to be estimated: the product has a price, and
+    either the price changed or the product has never had fees."""
+    missing = listing.get('missing', [])
+    return 'price' not in missing and ('price' in listing['changed'] or 'market_fees' in missing)
 
 
 @app.task(base=OpsTask, bind=True)
-def update_fba_fees(self, product_id):
-    """Updates the market_fees field with the total fee amount for the current price."""
+def update_amazon_listing(self, data, product_id):
+    """Updates a product using various sources of data. Only the fields whose values have changed are written, and
+    nothing is written if none have. Returns the product ID, a list of the changed fields, and a list of the
+    opportunity fields the product doesn't have."""
+    collection = self.db.products
+
+    product_id = ObjectId(product_id)
+    stored = collection.find_one({'_id': product_id})
+    if stored is None:
+        raise ValueError(f'Invalid product id: {product_id}')
+
+    # Write only the fields that changed
+    product = merge_listing_data(dict(stored), data)
+    changes = diff_fields(stored, product)
+    if changes:
+        collection.update_one(
+            filter={'_id': product_id},
+            update={'$set': changes}
+        )
+
+    # Only recalculate opportunities if something they depend on has changed
+    if changed_fields(stored, changes):
+        self.mark_dirty([product_id])
+
+    return listing_result(product, changes)
+
+
+@app.task(base=OpsTask, bind=True)
+def update_amazon_listings(self, data, product_ids):
+    """Like update_amazon_listing(), for many products at once: data is a list of API call results that cover all of
+    the products. Uses one query to load the products, and one bulk write. Returns a list of update_amazon_listing()
+    results. Products whose data can't be merged are logged and skipped, without holding up the rest."""
+    product_ids = [ObjectId(product_id) for product_id in product_ids]
+    results, writes, dirty = [], [], []
+
+    for stored in self.db.products.find({'_id': {'$in': product_ids}}):
+        try:
+            product = merge_listing_data(dict(stored), data)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f'Could not update listing {stored["_id"]}: {e!r}')
+            continue
+
+        changes = diff_fields(stored, product)
+        if changes:
+            writes.append(pymongo.UpdateOne({'_id': stored['_id']}, {'$set': changes}))
+        if changed_fields(stored, changes):
+            dirty.append(stored['_id'])
+
+        results.append(listing_result(product, changes))
+
+    if writes:
+        self.db.products.bulk_write(writes, ordered=False)
+    self.mark_dirty(dirty)
+
+    return results
+
+
+@app.task(base=OpsTask, bind=True)
+def update_fba_fees(self, listing):
+    """Updates the market_fees field with the total fee amount for the current price. listing is either a product ID,
+    or the result of update_amazon_listing(), in which case the fees are only updated if the price has changed, or the
+    product doesn't have any fees yet."""
+    if isinstance(listing, dict):
+        if not needs_fees(listing):
+            return listing
+        product_id = listing['product_id']
+    else:
+        product_id = listing
+
     collection = self.db.products
     product = collection.find_one({'_id': ObjectId(product_id)})
     if product is None:
@@ -150,23 +332,79 @@ def update_fba_fees(self, product_id):
 
 
 @app.task(base=OpsTask, bind=True)
-def update_opportunity(self, opp_id):
-    """Recalculate opportunity metrics."""
-    opp_collection = self.db.opportunities
-    opp = opp_collection.find_one({'_id': ObjectId(opp_id)})
-    if opp is None:
-        raise ValueError(f'Invalid opportunity ID: {opp_id}')
+def update_fba_fees_many(self, listings):
+    """Like update_fba_fees(), for a list of update_amazon_listing() results. Fees are only estimated for the products
+    that need them (see needs_fees()), in as few API calls as possible, and written with one bulk write."""
+    product_ids = [ObjectId(listing['product_id']) for listing in listings if needs_fees(listing)]
+    if not product_ids:
+        return []
+
+    products = list(self.db.products.find({'_id': {'$in': product_ids}, 'price': {'$ne': None}},
+                                          {'sku': 1, 'price': 1}))
+    estimates = [(product['sku'], product['price']) for product in products]
+    size = mws.products.GetMyFeesEstimate.batch_size
+
+    return update_amazon_listings(
+        [GetMyFeesEstimate(estimates=estimates[i:i + size], coalesce=False) for i in range(0, len(estimates), size)],
+        [str(product['_id']) for product in products]
+    )
 
-    vendors = self.db.vendors
-    products = self.db.products
 
-    market_listing = products.find_one({'_id': opp['market_listing']})
-    supplier_listing = products.find_one({'_id': opp['supplier_listing']})
+def opportunity_pipeline(match):
+    """Return an aggregation pipeline that joins the opportunities matching match with their market and supplier
+    listings, keeping only the fields needed to calculate the opportunity metrics. Vendors come from the vendor cache,
+    see join_vendors()."""
+    lookups = []
+    for side in ('market', 'supplier'):
+        lookups += [
+            {'$lookup': {'from': 'products', 'localField': f'{side}_listing', 'foreignField': '_id',
+                         'as': f'{side}_product'}},
+            {'$unwind': {'path': f'${side}_product', 'preserveNullAndEmptyArrays': True}}
+        ]
+
+    return [
+        {'$match': match},
+        {'$project': {'market_listing': 1, 'supplier_listing': 1}},
+        *lookups,
+        {'$project': {
+            'market_listing': 1,
+            'supplier_listing': 1,
+            'market_product.vendor': 1,
+            'market_product.price': 1,
+            'market_product.quantity': 1,
+            'market_product.market_fees': 1,
+            'supplier_product.vendor': 1,
+            'supplier_product.price': 1,
+            'supplier_product.quantity': 1,
+            'supplier_product.ship_rate': 1
+        }}
+    ]
+
+
+def join_vendors(db, opps):
+    """Add the market and supplier vendors to each opportunity from opportunity_pipeline(), using the vendor cache.
+    Vendors that don't exist are left out."""
+    for opp in opps:
+        for side in ('market', 'supplier'):
+            product = opp.get(f'{side}_product')
+            vendor = vendor_cache.get(db, product.get('vendor')) if product is not None else None
+            if vendor is not None:
+                opp[f'{side}_vendor'] = vendor
+
+        yield opp
+
+
+def calculate_opportunity(opp):
+    """Calculate the profit, margin and ROI of an opportunity, joined with its listings and vendors by
+    opportunity_pipeline() and join_vendors(). Raises ValueError if a listing or vendor is missing, or doesn't have the
+    required data."""
+    market_listing = opp.get('market_product')
+    supplier_listing = opp.get('supplier_product')
     if None in (market_listing, supplier_listing):
         raise ValueError(f'Invalid product ID: {opp["market_listing"] if market_listing is None else opp["supplier_listing"]}')
 
-    market_vendor = vendors.find_one({'_id': market_listing['vendor']})
-    supplier_vendor = vendors.find_one({'_id': supplier_listing['vendor']})
+    market_vendor = opp.get('market_vendor')
+    supplier_vendor = opp.get('supplier_vendor')
     if None in (market_vendor, supplier_vendor):
         raise ValueError(f'Invalid vendor ID: {market_listing["vendor"] if market_vendor is None else supplier_listing["vendor"]}')
 
@@ -177,25 +415,121 @@ def update_opportunity(self, opp_id):
         market_price = market_listing['price']
         market_quantity = market_listing['quantity']['numeric']
         market_fees = market_listing['market_fees']
-    except (KeyError, TypeError):
-        raise ValueError(f'market_listing or supplier_listing do not contain required data, or it is not in the correct'
-                         f'format.')
 
-    revenue = market_price - market_fees
-    subtotal = (supplier_price / supplier_quantity) * market_quantity
-    shipping = ship_rate * subtotal
+        revenue = market_price - market_fees
+        subtotal = (supplier_price / supplier_quantity) * market_quantity
+        shipping = ship_rate * subtotal
 
-    profit = revenue - subtotal - shipping
-    margin = profit / market_price
-    roi = profit / (subtotal + shipping)
+        profit = revenue - subtotal - shipping
+        margin = profit / market_price
+        roi = profit / (subtotal + shipping)
+    except (KeyError, TypeError, ZeroDivisionError):
+        raise ValueError(f'market_listing or supplier_listing do not contain required data, or it is not in the '
+                         f'correct format.')
 
-    opp['profit'] = profit
-    opp['margin'] = margin
-    opp['roi'] = roi
+    return {
+        'profit': profit,
+        'margin': margin,
+        'roi': roi
+    }
 
-    opp_collection.find_one_and_update(
-        filter={'_id': ObjectId(opp_id)},
-        update={'$set': opp}
-    )
 
-    return opp_id
\ No newline at end of file
+def recompute_opportunities(db, match, batch_size=500):
+    """Recalculate the metrics of every opportunity matching match, with one aggregation to load them and a bulk write
+    for every batch_size opportunities. Returns a tuple of (updated IDs, {ID: error message})."""
+    updated, errors, writes = [], {}, []
+
+    for opp in join_vendors(db, db.opportunities.aggregate(opportunity_pipeline(match))):
+        try:
+            metrics = calculate_opportunity(opp)
+        except ValueError as e:
+            errors[str(opp['_id'])] = str(e)
+            continue
+
+        writes.append(pymongo.UpdateOne({'_id': opp['_id']}, {'$set': metrics}))
+        updated.append(str(opp['_id']))
+
+        if len(writes) >= batch_size:
+            db.opportunities.bulk_write(writes, ordered=False)
+            writes = []
+
+    if writes:
+        db.opportunities.bulk_write(writes, ordered=False)
+
+    return updated, errors
+
+
+@app.task(base=OpsTask, bind=True)
+def update_opportunities(self, opp_ids=None, product_ids=None):
+    """Recalculate the metrics of many opportunities at once: the ones in opp_ids, and the ones whose market or
+    supplier listing is in product_ids."""
+    opp_ids = [ObjectId(opp_id) for opp_id in opp_ids or []]
+    product_ids = [ObjectId(product_id) for product_id in product_ids or []]
+
+    match = {'$or': [
+        {'_id': {'$in': opp_ids}},
+        {'market_listing': {'$in': product_ids}},
+        {'supplier_listing': {'$in': product_ids}}
+    ]}
+
+    updated, errors = recompute_opportunities(self.db, match, self.bulk_batch_size)
+    for opp_id, message in errors.items():
+        logger.debug(f'Could not update opportunity {opp_id}: {message}')
+
+    return {
+        'updated': updated,
+        'errors': errors
+    }
+
+
+@app.task(base=OpsTask, bind=True)
+def update_opportunity(self, opp_id):
+    """Recalculate opportunity metrics."""
+    updated, errors = recompute_opportunities(self.db, {'_id': ObjectId(opp_id)})
+    if errors:
+        raise ValueError(errors[str(opp_id)])
+    elif not updated:
+        raise ValueError(f'Invalid opportunity ID: {opp_id}')
+
+    return opp_id
+
+
+@app.task(base=OpsTask, bind=True)
+def recompute_dirty_opportunities(self, max_products=10000):
+    """Recalculate the opportunities of every product marked dirty since the last run, each one exactly once, no matter
+    how many times its products were marked. Runs periodically (see the beat schedule in worker.py)."""
+    product_ids = []
+    while len(product_ids) < max_products:
+        popped = self.redis.spop(dirty_products_key, min(self.bulk_batch_size, max_products - len(product_ids)))
+        if not popped:
+            break
+        product_ids += [ObjectId(product_id.decode()) for product_id in popped]
+
+    if not product_ids:
+        return {'products': 0, 'updated': 0, 'errors': 0}
+
+    try:
+        # Uses the (market_listing, supplier_listing) and (supplier_listing) indexes
+        opp_ids = set()
+        for start in range(0, len(product_ids), self.bulk_batch_size):
+            batch = product_ids[start:start + self.bulk_batch_size]
+            for field in ('market_listing', 'supplier_listing'):
+                opp_ids.update(doc['_id'] for doc in self.db.opportunities.find({field: {'$in': batch}}, {'_id': 1}))
+
+        opp_ids = list(opp_ids)
+        updated, errors = 0, 0
+        for start in range(0, len(opp_ids), self.bulk_batch_size):
+            batch_updated, batch_errors = recompute_opportunities(
+                self.db,
+                {'_id': {'$in': opp_ids[start:start + self.bulk_batch_size]}},
+                self.bulk_batch_size
+            )
+            updated += len(batch_updated)
+            errors += len(batch_errors)
+    except Exception:
+        # Put the products back, so the next run picks them up again
+        self.mark_dirty(product_ids)
+        raise
+
+    logger.info(f'Recomputed {updated} opportunities for {len(product_ids)} changed products ({errors} errors)')
+    return {'products': len(product_ids), 'updated': updated, 'errors': errors}
@@ -0,0 +1,161 @@
+import itertools
+import numpy as np
+from celery.utils.log import get_task_logger
+from bson import ObjectId
+from .common import *
+from .products import opportunity_pipeline, join_vendors
+
+
+logger = get_task_logger(__name__)
+
+
+########################################################################################################################
+
+
+# Column name -> path of the value in a document from opportunity_pipeline() and join_vendors()
+columns = {
+    'supplier_price': ('supplier_product', 'price'),
+    'supplier_quantity': ('supplier_product', 'quantity', 'numeric'),
+    'ship_rate': ('supplier_product', 'ship_rate'),
+    'vendor_ship_rate': ('supplier_vendor', 'ship_rate'),
+    'market_price': ('market_product', 'price'),
+    'market_quantity': ('market_product', 'quantity', 'numeric'),
+    'market_fees': ('market_product', 'market_fees')
+}
+
+
+def get_number(doc, path):
+    """Return a tuple of (value, missing) for the number at path in doc. The value is a float, or NaN if it is missing
+    or isn't a number. Like calculate_opportunity(), only ints and floats are numbers: numeric strings are not."""
+    try:
+        for key in path:
+            doc = doc[key]
+    except KeyError:
+        return np.nan, True
+    except TypeError:
+        return np.nan, False
+
+    if isinstance(doc, (int, float)):
+        return float(doc), False
+    return np.nan, False
+
+
+def load_columns(docs):
+    """Load the fields needed to calculate opportunity metrics into one array per column, plus a 'joined' column that
+    is False where a listing or vendor is missing, and a 'missing' dictionary of {column: array} that is True where a
+    field isn't there at all. Returns a tuple of (list of opportunity IDs, {column: array})."""
+    ids, joined = [], []
+    values, missing = {name: [] for name in columns}, {name: [] for name in columns}
+    for doc in docs:
+        ids.append(doc['_id'])
+        joined.append(all(key in doc for key in ('market_product', 'supplier_product', 'market_vendor',
+                                                 'supplier_vendor')))
+        for name, path in columns.items():
+            value, is_missing = get_number(doc, path)
+            values[name].append(value)
+            missing[name].append(is_missing)
+
+    data = {name: np.array(column, dtype=np.float64) for name, column in values.items()}
+    data['joined'] = np.array(joined, dtype=bool)
+    data['missing'] = {name: np.array(column, dtype=bool) for name, column in missing.items()}
+    return ids, data
+
+
+def calculate_metrics(data):
+    """Calculate profit, margin and ROI for every row in data, the same way as calculate_opportunity(). Returns a tuple
+    of ({metric: array}, valid), where valid is a boolean array that is False for the rows with a missing listing or
+    vendor, missing data, or where the margin or ROI would be a division by zero. The metrics of invalid rows are
+    undefined."""
+    # Listings without a ship rate fall back to the vendor's ship rate, and then to 0. A ship rate that is there, but
+    # isn't a number, stays NaN and makes the row invalid.
+    missing = data['missing']
+    ship_rate = np.where(missing['ship_rate'], data['vendor_ship_rate'], data['ship_rate'])
+    ship_rate = np.where(missing['ship_rate'] & missing['vendor_ship_rate'], 0.0, ship_rate)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        revenue = data['market_price'] - data['market_fees']
+        subtotal = (data['supplier_price'] / data['supplier_quantity']) * data['market_quantity']
+        shipping = ship_rate * subtotal
+
+        profit = revenue - subtotal - shipping
+        margin = profit / data['market_price']
+        roi = profit / (subtotal + shipping)
+
+    valid = data['joined'] & np.isfinite(profit) & np.isfinite(margin) & np.isfinite(roi)
+    return {'profit': profit, 'margin': margin, 'roi': roi}, valid
+
+
+def listing_match(product_ids):
+    """Return a filter for the opportunities whose market or supplier listing is in product_ids."""
+    return {'$or': [{'market_listing': {'$in': product_ids}}, {'supplier_listing': {'$in': product_ids}}]}
+
+
+def reprice(task, match):
+    """Recalculate and write back the metrics of the opportunities that match a filter. Returns the number of
+    opportunities updated and skipped."""
+    ids, data = load_columns(join_vendors(task.db, task.db.opportunities.aggregate(opportunity_pipeline(match))))
+    metrics, valid = calculate_metrics(data)
+
+    rows = np.flatnonzero(valid)
+    for start in range(0, len(rows), task.bulk_batch_size):
+        task.db.opportunities.bulk_write(
+            [
+                pymongo.UpdateOne(
+                    {'_id': ids[row]},
+                    {'$set': {name: float(values[row]) for name, values in metrics.items()}}
+                ) for row in rows[start:start + task.bulk_batch_size]
+            ],
+            ordered=False
+        )
+
+    return len(rows), len(ids) - len(rows)
+
+
+########################################################################################################################
+
+
+@app.task(base=OpsTask, bind=True)
+def reprice_opportunities(self, vendor=None, product_ids=None):
+    """Recalculate the metrics of every opportunity for a vendor (by name), or for the products in product_ids, or of
+    every opportunity if neither is given. The data is loaded with a single aggregation, the metrics are calculated
+    for all opportunities at once, and the results are written back in bulk. Opportunities with missing data are
+    skipped.
+
+    A vendor's opportunities are repriced bulk_batch_size products at a time instead, with one aggregation for each
+    batch, since the IDs of a large vendor's products don't fit in a single query.
+
+    The vendors are reloaded first: this task is queued right after a vendor changes, and may run before this process
+    has heard about it."""
+    vendor_cache.load(self.db)
+
+    match = {}
+    if product_ids is not None:
+        match = listing_match([ObjectId(product_id) for product_id in product_ids])
+
+    updated, skipped = 0, 0
+    if vendor is None:
+        updated, skipped = reprice(self, match)
+    else:
+        vendor_doc = vendor_cache.get_by_name(self.db, vendor)
+        if vendor_doc is None:
+            raise ValueError(f'Invalid vendor: {vendor}')
+
+        # Filter on the vendor's listings before the lookups, so only its opportunities are joined
+        vendor_products = (doc['_id'] for doc in self.db.products.find({'vendor': vendor_doc['_id']}, {'_id': 1}))
+        while True:
+            batch = list(itertools.islice(vendor_products, self.bulk_batch_size))
+            if not batch:
+                break
+
+            batch_match = {'$and': [match, listing_match(batch)]} if match else listing_match(batch)
+            batch_updated, batch_skipped = reprice(self, batch_match)
+            updated += batch_updated
+            skipped += batch_skipped
+
+    if skipped:
+        logger.debug(f'Skipped {skipped} opportunities with missing or invalid data')
+
+    return {
+        'updated': updated,
+        'skipped': skipped
+    }
@@ -1,13 +1,14 @@
+import hashlib
+import json
 from .common import *
+from .products import find_amazon_matches_many
 
 
 ########################################################################################################################
 
 
-@app.task(base=OpsTask, bind=True)
-def clean_and_import(self, data):
-    """Cleans, validates, and imports product data from a spider."""
-
+def clean_item(data):
+    """Validate and clean an item from a spider, in place."""
     # Verify that required fields are present and valid
     required_fields = ['vendor', 'sku']
     for field in required_fields:
@@ -18,12 +19,34 @@ def clean_and_import(self, data):
         if isinstance(value, str):
             data[field] = value.strip()
 
-    # Get or create vendor
-    vendor_id = self.get_or_create_vendor(data.pop('vendor'))
+    return data
+
+
+def content_hash(data):
+    """Return a hash of an item's contents that doesn't depend on the order of its fields."""
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def prepare_item(task, data):
+    """Clean an item, and replace its vendor name with the vendor's ID. The item is stored with a hash of its contents,
+    so that later imports can tell whether it has changed. Returns a tuple of (vendor ID, item)."""
+    data = clean_item(dict(data))
+    vendor_id = task.get_or_create_vendor(data.pop('vendor'))
+    data['content_hash'] = content_hash(data)
+    return vendor_id, data
+
+
+########################################################################################################################
+
+
+@app.task(base=OpsTask, bind=True)
+def clean_and_import(self, data):
+    """Cleans, validates, and imports product data from a spider."""
+    vendor_id, data = prepare_item(self, data)
 
     # Upsert into products collection
     products = self.db['products']
-    products.find_one_and_update(
+    before = products.find_one_and_update(
         filter={'vendor': vendor_id, 'sku': data['sku']},
         update={
             '$set': {
@@ -31,8 +54,77 @@ def clean_and_import(self, data):
                 **data
             }
         },
+        projection={f: 1 for f in opportunity_fields},
         upsert=True
     )
 
+    # New products don't have any opportunities yet
+    if before is not None and changed_fields(before, data):
+        self.mark_dirty([before['_id']])
+
     # Trigger follow-up actions:
-    #   Find matching Amazon products
\ No newline at end of file
+    #   Find matching Amazon products
+
+
+@app.task(base=OpsTask, bind=True)
+def bulk_clean_and_import(self, items, find_matches=True):
+    """Clean, validate, and import a batch of items from a spider.
+
+    Items are deduplicated by vendor and SKU (the last one wins), and each one is stored with a hash of its contents.
+    Only the items that are new, or whose hash differs from the stored one, are written, in a single bulk write. If
+    find_matches is True, Amazon matches are looked up for the new and changed items that have a brand and model.
+    Returns the SKUs of the new and changed items, and the number of unchanged ones."""
+    # Deduplicate by (vendor, SKU)
+    batch = {}
+    for data in items:
+        vendor_id, data = prepare_item(self, data)
+        batch[(vendor_id, data['sku'])] = data
+
+    # Load the stored hashes, with one query per vendor (usually there's only one)
+    stored = {}
+    for vendor_id in {vendor_id for vendor_id, _ in batch}:
+        skus = [sku for vid, sku in batch if vid == vendor_id]
+        for doc in self.db.products.find(
+                filter={'vendor': vendor_id, 'sku': {'$in': skus}},
+                projection={'sku': 1, 'content_hash': 1, **{f: 1 for f in opportunity_fields}}):
+            stored[(vendor_id, doc['sku'])] = doc
+
+    writes, keys = [], []
+    for key, data in batch.items():
+        if key in stored and stored[key].get('content_hash') == data['content_hash']:
+            continue
+
+        writes.append(
+            pymongo.UpdateOne(
+                filter={'vendor': key[0], 'sku': key[1]},
+                update={'$set': {'vendor': key[0], **data}},
+                upsert=True
+            )
+        )
+        keys.append(key)
+
+    product_ids = {}
+    if writes:
+        result = self.db.products.bulk_write(writes, ordered=False)
+        product_ids.update({keys[index]: _id for index, _id in result.upserted_ids.items()})
+
+    new = [key for key in keys if key not in stored]
+    changed = [key for key in keys if key in stored]
+    product_ids.update({key: stored[key]['_id'] for key in changed})
+
+    # New products don't have any opportunities yet
+    self.mark_dirty([stored[key]['_id'] for key in changed if changed_fields(stored[key], batch[key])])
+
+    if find_matches:
+        products = [
+            {'product_id': str(product_ids[key]), 'brand': batch[key].get('brand'), 'model': batch[key].get('model')}
+            for key in new + changed if key in product_ids
+        ]
+        if products:
+            find_amazon_matches_many.delay(products)
+
+    return {
+        'new': [sku for _, sku in new],
+        'changed': [sku for _, sku in changed],
+        'unchanged': len(batch) - len(keys)
+    }
@@ -0,0 +1,24 @@
+from .common import *
+from .repricing import reprice_opportunities
+
+
+########################################################################################################################
+
+
+@app.task(base=OpsTask, bind=True)
+def update_vendor(self, name, **fields):
+    """Update (or create) a vendor, and tell every worker process to drop its cached copy. Changing the ship rate also
+    reprices the vendor's opportunities."""
+    vendor = self.db.vendors.find_one_and_update(
+        filter={'name': name},
+        update={'$set': {'name': name, **fields}},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+
+    vendor_cache.publish_change(self.redis, vendor['_id'])
+
+    if 'ship_rate' in fields:
+        reprice_opportunities.delay(vendor=name)
+
+    return str(vendor['_id'])
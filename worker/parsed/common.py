@@ -1,4 +1,7 @@
+import os
 import re
+import json
+import redis
 from lxml import etree
 
 from worker import app
@@ -23,8 +26,62 @@ def format_parsed_response(action, params, results=None, errors=None, succeeded=
 ########################################################################################################################
 
 
+class EntityCache:
+    """Caches parsed results per item (ASIN, ItemId, etc.) instead of per request, so that a request for several items
+    can be assembled from the results of earlier requests, and only the missing items need to be fetched. Keys are
+    built from the action, a scope (usually the marketplace ID), and the item ID."""
+
+    def __init__(self, redis_url=None):
+        self._redis_url = redis_url
+        self._redis = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = redis.from_url(self._redis_url or os.environ['REDIS_URL'])
+
+        return self._redis
+
+    @staticmethod
+    def build_key(action, scope, item_id):
+        return f'parsed.{action}_{scope}_{item_id}'
+
+    def get_many(self, action, scope, item_ids):
+        """Return a dictionary of the cached results for item_ids. Items that aren't cached are left out."""
+        if not item_ids:
+            return {}
+
+        values = self.redis.mget([self.build_key(action, scope, item_id) for item_id in item_ids])
+        return {item_id: json.loads(value) for item_id, value in zip(item_ids, values) if value is not None}
+
+    def set_many(self, action, scope, results, ttl):
+        """Cache each item in results (a dictionary of item ID -> result) for ttl seconds."""
+        if not results or not ttl:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        for item_id, result in results.items():
+            pipe.set(self.build_key(action, scope, item_id), json.dumps(result), ex=ttl)
+        pipe.execute()
+
+
+entity_cache = EntityCache()
+
+
+########################################################################################################################
+
+
 class AmzXmlResponse:
-    """A utility class for dealing with Amazon's XML responses."""
+    """A utility class for dealing with Amazon's XML responses.
+
+    Responses are parsed once, as-is, and namespaces are left in the tree. Paths passed to xpath_get() are written
+    without namespaces (e.g. './/ItemAttributes/Brand') and match elements by their local name, in any namespace. Code
+    that walks the tree directly should do the same, using '{*}' wildcards (e.g. tree.iterdescendants('{*}Item')).
+    """
+    re_step = re.compile(r'(^|/)([A-Za-z_][\w.-]*)')
+
+    # Compiled paths, shared by all responses
+    _paths = {}
 
     def __init__(self, xml=None):
         self._xml = None
@@ -42,31 +99,48 @@ class AmzXmlResponse:
         self._xml, self.tree = None, None
 
         if xml is not None:
-            self._xml = self.remove_namespaces(xml)
-            self.tree = etree.fromstring(self._xml)
+            self._xml = xml
+            self.tree = etree.fromstring(xml.encode() if isinstance(xml, str) else xml)
 
-    @staticmethod
-    def remove_namespaces(xml):
-        """Remove all traces of namespaces from the given XML string."""
-        re_ns_decl = re.compile(r' xmlns(:\w*)?="[^"]*"', re.IGNORECASE)
-        re_ns_open = re.compile(r'<\w+:')
-        re_ns_close = re.compile(r'/\w+:')
+    @classmethod
+    def compile_path(cls, path):
+        """Translate a simple XPath location path into a function that returns the first matching element, or None.
+        Every step matches elements by local name, ignoring namespaces. Paths are only translated once."""
+        try:
+            return cls._paths[path]
+        except KeyError:
+            pass
+
+        if path.startswith('//'):
+            # Search the whole document, regardless of the context element
+            find_path = cls.re_step.sub(r'\1{*}\2', '.' + path)
+            find = lambda tag: tag.getroottree().getroot().find(find_path)
+        elif path.startswith('/'):
+            # The first step has to match the root element
+            root_name, _, rest = path[1:].partition('/')
+            find_path = cls.re_step.sub(r'\1{*}\2', rest)
 
-        response = re_ns_decl.sub('', xml)  # Remove namespace declarations
-        response = re_ns_open.sub('<', response)  # Remove namespaces in opening tags
-        response = re_ns_close.sub('/', response)  # Remove namespaces in closing tags
-        return response
+            def find(tag):
+                root = tag.getroottree().getroot()
+                if etree.QName(root).localname != root_name:
+                    return None
+                return root.find(find_path) if find_path else root
+        else:
+            find_path = cls.re_step.sub(r'\1{*}\2', path)
+            find = lambda tag: tag.find(find_path)
+
+        return cls._paths.setdefault(path, find)
 
     def xpath_get(self, path, root_tag=None, _type=str, default=None):
         """Utility method for getting data values from XPath selectors."""
         tag = root_tag if root_tag is not None else self.tree
         try:
-            data = tag.xpath(path)[0].text
+            data = self.compile_path(path)(tag).text
             if _type is str and data is None:
                 raise TypeError
             else:
                 return _type(data)
-        except (IndexError, ValueError, TypeError):
+        except (AttributeError, ValueError, TypeError):
             return default
 
     @property
@@ -101,4 +175,154 @@ class AmzXmlResponse:
                 'message': self.error_message,
                 'request_id': self.request_id
             }
-        }
\ No newline at end of file
+        }
+
+
+class AmzXmlStream(AmzXmlResponse):
+    """Parses an Amazon XML response incrementally, instead of building the whole tree up front.
+
+    iter_elements() yields the elements with the given local names as soon as they have been parsed. Once the caller
+    asks for the next element, the previous one is cleared and removed from the tree, along with anything before it, so
+    the tree never holds more than one item at a time. Matching elements must not be nested inside each other, and must
+    be used before the next one is requested.
+
+    The rest of the tree (and with it error_code, error_message, etc.) is available once the stream is exhausted."""
+    chunk_size = 64 * 1024
+
+    def __init__(self, xml=None):
+        super().__init__()
+        self._xml = xml
+
+    def iter_elements(self, *names):
+        """Parse the response, yielding each element whose local name is in names."""
+        self.tree = None
+        if self._xml is None:
+            return
+
+        # The response is fed to the parser in chunks, so it is never copied as a whole
+        parser = etree.XMLPullParser(events=('end',), tag=[f'{{*}}{name}' for name in names])
+        for start in range(0, len(self._xml), self.chunk_size):
+            chunk = self._xml[start:start + self.chunk_size]
+            parser.feed(chunk.encode() if isinstance(chunk, str) else chunk)
+
+            for _, element in parser.read_events():
+                yield element
+
+                element.clear()
+                parent = element.getparent()
+                if parent is not None:
+                    while element.getprevious() is not None:
+                        del parent[0]
+
+        self.tree = parser.close()
+
+
+class AmzResponseError(Exception):
+    """Raised by the streaming parsers when the API returns an error response."""
+
+    def __init__(self, error):
+        super().__init__(f'{error["error"]["code"]}: {error["error"]["message"]}')
+        self.error = error
+
+
+########################################################################################################################
+
+
+class Field:
+    """Describes a value to extract from an item element: one or more paths to try in order (the first one that yields
+    a value wins), the type to convert the text to, and a default. If join is given, the text of every element
+    matching the path is joined together instead."""
+
+    def __init__(self, *paths, _type=str, default=None, join=None):
+        self.paths = paths
+        self._type = _type
+        self.default = default
+        self.join = join
+
+
+class Schema:
+    """A set of fields that can be extracted from an item element in a single pass.
+
+    Paths are compiled when the schema is created. Paths of the form './/Name' or './/Parent/Name' are resolved from an
+    index of the item's descendants, built by walking the item once; any other path is evaluated with
+    AmzXmlResponse.compile_path(). The values are the same as AmzXmlResponse.xpath_get() would return."""
+    re_indexed = re.compile(r'^\.//(?:([A-Za-z_][\w.-]*)/)?([A-Za-z_][\w.-]*)$')
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self._names = {}    # local name -> set of parent names to index it under (None for the name by itself)
+        self._lookups = {}  # path -> index key, or a compiled path function
+
+        for field in fields.values():
+            for path in field.paths:
+                match = self.re_indexed.match(path)
+                if match:
+                    parent, name = match.groups()
+                    self._names.setdefault(name, set()).add(parent)
+                    self._lookups[path] = f'{parent}/{name}' if parent else name
+                elif field.join is None:
+                    self._lookups[path] = AmzXmlResponse.compile_path(path)
+                else:
+                    raise ValueError(f'Joined fields only support .//Name paths: {path}')
+
+    def index(self, item):
+        """Walk the descendants of item once, and return a dictionary of index key -> matching elements, in document
+        order."""
+        index = {}
+        for element in item.iterdescendants():
+            tag = element.tag
+            if tag.__class__ is not str:
+                continue
+
+            name = tag[tag.find('}') + 1:]
+            parents = self._names.get(name)
+            if parents is None:
+                continue
+
+            for parent in parents:
+                if parent is None:
+                    index.setdefault(name, []).append(element)
+                else:
+                    parent_tag = element.getparent().tag
+                    if parent_tag[parent_tag.find('}') + 1:] == parent:
+                        index.setdefault(f'{parent}/{name}', []).append(element)
+
+        return index
+
+    def extract(self, item):
+        """Return a dictionary of field name -> value for item."""
+        index = self.index(item)
+        values = {}
+
+        for name, field in self.fields.items():
+            if field.join is not None:
+                texts = [element.text for element in index.get(self._lookups[field.paths[0]], ()) if element.text]
+                values[name] = field.join.join(texts) or field.default
+                continue
+
+            value = None
+            for path in field.paths:
+                lookup = self._lookups[path]
+                if callable(lookup):
+                    element = lookup(item)
+                else:
+                    element = index.get(lookup, (None,))[0]
+
+                value = self.convert(element, field._type)
+                if value:
+                    break
+
+            values[name] = value if value is not None else field.default
+
+        return values
+
+    @staticmethod
+    def convert(element, _type):
+        """Convert the text of element to _type, the same way as AmzXmlResponse.xpath_get()."""
+        try:
+            data = element.text
+            if _type is str and data is None:
+                return None
+            return _type(data)
+        except (AttributeError, ValueError, TypeError):
+            return None
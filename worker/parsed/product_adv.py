@@ -1,3 +1,5 @@
+import hashlib
+import json
 from .common import *
 import mws.product_adv as product_adv
 from lib.amazonmws.amazonmws import MARKETID
@@ -6,6 +8,32 @@ from lib.amazonmws.amazonmws import MARKETID
 ########################################################################################################################
 
 
+def cents(text):
+    """Convert a price in cents, as returned by the Product Advertising API, to dollars."""
+    return float(text) / 100
+
+
+item_schema = Schema(
+    sku=Field('.//ASIN'),
+    rank=Field('.//SalesRank', _type=int),
+    image_url=Field('.//LargeImage/URL'),
+    brand=Field('.//Brand', './/Manufacturer', './/Label', './/Publisher', './/Studio', './/Model'),
+    model=Field('.//Model', './/MPN', './/PartNumber'),
+    NumberOfItems=Field('.//NumberOfItems', _type=int),
+    PackageQuantity=Field('.//PackageQuantity', _type=int),
+    title=Field('.//Title'),
+    upc=Field('.//UPC'),
+    merchant=Field('.//Merchant'),
+    prime=Field('.//IsEligibleForPrime'),
+    features=Field('.//Feature', join='\n'),
+    description=Field('.//EditorialReview/Content'),
+    price=Field('.//LowestNewPrice/Amount', _type=cents)
+)
+
+
+########################################################################################################################
+
+
 @app.task
 def ItemSearch(SearchIndex, **kwargs):
     raise NotImplementedError
@@ -17,7 +45,10 @@ def BrowseNodeLookup(BrowseNodeId, ResponseGroup=None):
 
 
 @app.task
-def ItemLookup(asin=None, **kwargs):
+def ItemLookup(asin=None, coalesce=True, use_cache=True, **kwargs):
+    """Perform an ItemLookup request. ASIN lookups are cached per ASIN, and only the ASINs that aren't cached are
+    requested. When coalesce is True, the lookup may be combined with concurrent lookups from other tasks; only the
+    results and errors for the ItemIds requested by this call are returned."""
     params = {
         'ResponseGroup': 'Images,ItemAttributes,OfferFull,SalesRank,EditorialReview'
     }
@@ -27,51 +58,54 @@ def ItemLookup(asin=None, **kwargs):
         **kwargs
     )
 
-    response = AmzXmlResponse(
-        product_adv.ItemLookup(**params)
+    # Results are keyed by ASIN, so they can only be matched to the request (and cached) for ASIN lookups
+    by_asin = params['IdType'] == 'ASIN'
+    requested = [sku.strip().upper() for sku in params['ItemId'].split(',')]
+    scope = hashlib.md5(json.dumps({k: v for k, v in params.items() if k != 'ItemId'}, sort_keys=True).encode())\
+        .hexdigest()
+
+    cached = entity_cache.get_many('ItemLookup', scope, requested) if use_cache and by_asin else {}
+    missing = [sku for sku in requested if sku not in cached]
+    if not missing:
+        return format_parsed_response('ItemLookup', params, cached)
+
+    response = AmzXmlStream(
+        product_adv.ItemLookup(**{**params, 'ItemId': ','.join(missing)}, coalesce=coalesce, use_cache=use_cache)
     )
 
-    errors = {}
-    for error_tag in response.tree.iterdescendants('Error'):
-        code = response.xpath_get('.//Code', error_tag)
-        message = code + ': ' + response.xpath_get('.//Message', error_tag)
-        asin = [sku for sku in kwargs['ItemId'].split(',') if sku.strip().upper() in message]
-        if asin:
-            errors[asin[0]] = message
+    # The request echo comes before any errors or items, and holds every ItemId in the (possibly coalesced) batch
+    batch_ids = []
+    errors, results = {}, {}
+    for tag in response.iter_elements('ItemLookupRequest', 'Error', 'Item'):
+        name = etree.QName(tag).localname
+
+        if name == 'ItemLookupRequest':
+            item_ids = response.xpath_get('./ItemId', tag, default='')
+            batch_ids = [sku.strip().upper() for sku in item_ids.split(',')]
+
+        elif name == 'Error':
+            code = response.xpath_get('.//Code', tag)
+            message = code + ': ' + response.xpath_get('.//Message', tag)
+            asin = [sku for sku in missing if sku in message]
+            if asin:
+                errors[asin[0]] = message
+            elif not [sku for sku in batch_ids if sku in message]:
+                errors.setdefault('other', []).append(message)
+
         else:
-            errors['other'] = errors.get('other', []).append(message)
-
-    results = {}
-    for item_tag in response.tree.iterdescendants('Item'):
-        product = {}
-        product['sku'] = response.xpath_get('.//ASIN', item_tag)
-        product['detail_page_url'] = f'http://www.amazon.com/dp/{product["sku"]}'
-        product['rank'] = response.xpath_get('.//SalesRank', item_tag, _type=int)
-        product['image_url'] = response.xpath_get('.//LargeImage/URL', item_tag)
-        product['brand'] = response.xpath_get('.//Brand', item_tag)\
-            or response.xpath_get('.//Manufacturer', item_tag)\
-            or response.xpath_get('.//Label', item_tag)\
-            or response.xpath_get('.//Publisher', item_tag)\
-            or response.xpath_get('.//Studio', item_tag)\
-            or response.xpath_get('.//Model', item_tag)
-        product['model'] = response.xpath_get('.//Model', item_tag)\
-            or response.xpath_get('.//MPN', item_tag)\
-            or response.xpath_get('.//PartNumber', item_tag)
-        product['NumberOfItems'] = response.xpath_get('.//NumberOfItems', item_tag, _type=int)
-        product['PackageQuantity'] = response.xpath_get('.//PackageQuantity', item_tag, _type=int)
-        product['title'] = response.xpath_get('.//Title', item_tag)
-        product['upc'] = response.xpath_get('.//UPC', item_tag)
-        product['merchant'] = response.xpath_get('.//Merchant', item_tag)
-        product['prime'] = response.xpath_get('.//IsEligibleForPrime', item_tag)
-        product['features'] = '\n'.join((t.text for t in item_tag.iterdescendants('Feature'))) or None
-        product['description'] = response.xpath_get('.//EditorialReview/Content', item_tag)
-
-        price = response.xpath_get('.//LowestNewPrice/Amount', _type=float)
-        product['price'] = price / 100 if price is not None else None
-
-        product = {k: v for k, v in product.items() if v is not None}
-        results[product['sku']] = product
+            product = item_schema.extract(tag)
+            if by_asin and product['sku'] not in missing:
+                continue
+
+            product['detail_page_url'] = f'http://www.amazon.com/dp/{product["sku"]}'
+            product = {k: v for k, v in product.items() if v is not None}
+            results[product['sku']] = product
+
+    # A stale response is already being refreshed in the background, so it is only cached for as long as it is fresh
+    if by_asin:
+        entity_cache.set_many('ItemLookup', scope, results, product_adv.ItemLookup.fresh_for)
 
+    results.update(cached)
     return format_parsed_response('ItemLookup', params, results, errors)
 
 @app.task
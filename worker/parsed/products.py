@@ -7,6 +7,22 @@ from lib.amazonmws.amazonmws import MARKETID
 ########################################################################################################################
 
 
+matching_product_schema = Schema(
+    sku=Field('./Identifiers/MarketplaceASIN/ASIN'),
+    brand=Field('.//Brand', './/Manufacturer', './/Label', './/Publisher', './/Studio'),
+    model=Field('.//Model', './/PartNumber'),
+    price=Field('.//ListPrice/Amount', _type=float),
+    NumberOfItems=Field('.//NumberOfItems', _type=int),
+    PackageQuantity=Field('.//PackageQuantity', _type=int),
+    image_url=Field('.//SmallImage/URL'),
+    title=Field('.//Title'),
+    description=Field('.//Feature', join='\n')
+)
+
+
+########################################################################################################################
+
+
 @app.task
 def GetServiceStatus(**kwargs):
     response = AmzXmlResponse(
@@ -16,13 +32,25 @@ def GetServiceStatus(**kwargs):
     return response.xpath_get('.//Status')
 
 
-@app.task
-def ListMatchingProducts(query=None, **kwargs):
-    """Perform a ListMatchingProducts request."""
+def iter_matching_products(response):
+    """Parse the products in a ListMatchingProducts response (an AmzXmlStream), yielding them one at a time."""
+    for tag in response.iter_elements('Product'):
+        product = matching_product_schema.extract(tag)
+
+        for rank_tag in tag.iterdescendants('{*}SalesRank'):
+            if not response.xpath_get('./ProductCategoryId', rank_tag, default='').isdigit():
+                product['category'] = response.xpath_get('./ProductCategoryId', rank_tag)
+                product['rank'] = response.xpath_get('./Rank', rank_tag, _type=int)
+                break
+
+        yield {k: v for k, v in product.items() if v is not None}
+
+
+def list_matching_products_params(query=None, **kwargs):
     # Allow two-letter abbreviations for MarketplaceId
     market_id = kwargs.pop('MarketplaceId', 'US')
     market_id = market_id if len(market_id) > 2 else MARKETID.get(market_id)
-    params = {
+    return {
         k: v for k, v in {
             'Query': kwargs.pop('Query', query),
             'MarketplaceId': market_id,
@@ -30,51 +58,48 @@ def ListMatchingProducts(query=None, **kwargs):
         }.items() if v is not None
     }
 
-    response = AmzXmlResponse(
-        products.ListMatchingProducts(**params, **kwargs)
+
+def stream_matching_products(query=None, **kwargs):
+    """Perform a ListMatchingProducts request, and yield the matching products one at a time as the response is
+    parsed. Raises AmzResponseError if the response is an error. This is a plain generator, not a task, for use inside
+    other tasks."""
+    response = AmzXmlStream(
+        products.ListMatchingProducts(**list_matching_products_params(query, **kwargs))
     )
 
+    yield from iter_matching_products(response)
+
     if response.error_code:
-        return format_parsed_response('ListMatchingProducts', params, errors=response.error_as_json())
+        raise AmzResponseError(response.error_as_json())
 
-    results = []
-    for tag in response.tree.iterdescendants('Product'):
-        product = dict()
-        product['sku'] = response.xpath_get('./Identifiers/MarketplaceASIN/ASIN', tag)
-        product['brand'] = response.xpath_get('.//Brand', tag) \
-                           or response.xpath_get('.//Manufacturer', tag) \
-                           or response.xpath_get('.//Label', tag) \
-                           or response.xpath_get('.//Publisher', tag) \
-                           or response.xpath_get('.//Studio', tag)
-        product['model'] = response.xpath_get('.//Model', tag) \
-                           or response.xpath_get('.//PartNumber', tag)
-        product['price'] = response.xpath_get('.//ListPrice/Amount', tag, _type=float)
-        product['NumberOfItems'] = response.xpath_get('.//NumberOfItems', tag, _type=int)
-        product['PackageQuantity'] = response.xpath_get('.//PackageQuantity', tag, _type=int)
-        product['image_url'] = response.xpath_get('.//SmallImage/URL', tag)
-        product['title'] = response.xpath_get('.//Title', tag)
-
-        for rank_tag in tag.iterdescendants('SalesRank'):
-            if not rank_tag.xpath('./ProductCategoryId')[0].text.isdigit():
-                product['category'] = response.xpath_get('./ProductCategoryId', rank_tag)
-                product['rank'] = response.xpath_get('./Rank', rank_tag, _type=int)
-                break
 
-        product['description'] = '\n'.join([t.text for t in tag.iterdescendants('Feature')]) or None
+@app.task
+def ListMatchingProducts(query=None, **kwargs):
+    """Perform a ListMatchingProducts request."""
+    params = list_matching_products_params(query, **kwargs)
+
+    response = AmzXmlStream(
+        products.ListMatchingProducts(**params)
+    )
+
+    results = list(iter_matching_products(response))
 
-        results.append({k: v for k, v in product.items() if v is not None})
+    if response.error_code:
+        return format_parsed_response('ListMatchingProducts', params, errors=response.error_as_json())
 
     return format_parsed_response('ListMatchingProducts', params, results)
 
 
 @app.task
-def GetMyFeesEstimate(asin=None, price=None, **kwargs):
-    """Return the total fees estimate for a given ASIN and price."""
-    # Allow two-letter marketplace abbreviations
+def GetMyFeesEstimate(asin=None, price=None, estimates=None, coalesce=True, **kwargs):
+    """Return the total fees estimate for a given ASIN and price. To estimate several products at once, pass a list
+    of (asin, price) pairs as estimates. When coalesce is True, the request entries may be sent together with
+    concurrent requests from other tasks; only the results for this call's entries are returned."""
     # Allow two-letter abbreviations for MarketplaceId
     market_id = kwargs.pop('MarketplaceId', 'US')
     market_id = market_id if len(market_id) > 2 else MARKETID.get(market_id)
 
+    estimates = estimates if estimates is not None else [(asin, price)]
     params = {
         'FeesEstimateRequestList': kwargs.pop('FeesEstimateRequestList', None) or [
             {
@@ -82,36 +107,48 @@ def GetMyFeesEstimate(asin=None, price=None, **kwargs):
                 'IdType': 'ASIN',
                 'IdValue': asin,
                 'IsAmazonFulfilled': 'true',
-                'Identifier': 'request1',
+                'Identifier': f'{asin}@{price}',
                 'PriceToEstimateFees.ListingPrice.CurrencyCode': 'USD',
                 'PriceToEstimateFees.ListingPrice.Amount': price
-            }
+            } for asin, price in estimates
         ],
         **kwargs
     }
 
-    response = AmzXmlResponse(
-        products.GetMyFeesEstimate(**params)
+    response = AmzXmlStream(
+        products.GetMyFeesEstimate(**params, coalesce=coalesce)
     )
 
-    if response.error_code:
-        return format_parsed_response('GetMyFeesEstimate', params, errors=response.error_as_json())
+    # Map each result back to the request entry it answers
+    requests = {entry['Identifier']: entry for entry in params['FeesEstimateRequestList']}
 
     results, errors = {}, {}
-    for result_tag in response.tree.iterdescendants('FeesEstimateResult'):
-        sku = response.xpath_get('.//FeesEstimateIdentifier/IdValue', result_tag)
+    for result_tag in response.iter_elements('FeesEstimateResult'):
+        request = requests.get(response.xpath_get('.//FeesEstimateIdentifier/SellerInputIdentifier', result_tag))
+        if request is None:
+            continue
 
-        if response.xpath_get('.//Status', result_tag) == 'Success':
-            results[sku] = {'total_fees_estimate': response.xpath_get('.//TotalFeesEstimate/Amount', _type=float)}
+        sku = request['IdValue']
+        if response.xpath_get('./Status', result_tag) == 'Success':
+            results[sku] = {
+                'price': request['PriceToEstimateFees.ListingPrice.Amount'],
+                'total_fees_estimate': response.xpath_get('.//TotalFeesEstimate/Amount', result_tag, _type=float)
+            }
         else:
-            errors[sku] = response.xpath_get('.//Error/Message')
+            errors[sku] = response.xpath_get('.//Error/Message', result_tag)
+
+    if response.error_code:
+        return format_parsed_response('GetMyFeesEstimate', params, errors=response.error_as_json())
 
     return format_parsed_response('GetMyFeesEstimate', params, results, errors)
 
 
 @app.task
-def GetCompetitivePricingForASIN(asin=None, **kwargs):
-    """Perform a GetCompetivePricingForASIN call and return the results as a simplified JSON dictionary."""
+def GetCompetitivePricingForASIN(asin=None, coalesce=True, use_cache=True, **kwargs):
+    """Perform a GetCompetivePricingForASIN call and return the results as a simplified JSON dictionary. Results are
+    cached per ASIN, and only the ASINs that aren't cached are requested. When coalesce is True, the call may be batched
+    together with concurrent calls from other tasks; only the results for the ASINs requested by this call are
+    returned."""
     market_id = kwargs.pop('MarketplaceId', 'US')
     market_id = market_id if len(market_id) > 2 else MARKETID.get(market_id)
 
@@ -121,14 +158,24 @@ def GetCompetitivePricingForASIN(asin=None, **kwargs):
         **kwargs
     }
 
-    response = AmzXmlResponse(
-        products.GetCompetitivePricingForASIN(**params)
+    requested = [sku.strip().upper() for sku in params['ASINList']]
+    results = entity_cache.get_many('GetCompetitivePricingForASIN', market_id, requested) if use_cache else {}
+    missing = [sku for sku in requested if sku not in results]
+    errors = {}
+
+    if not missing:
+        return format_parsed_response('GetCompetitivePricingForASIN', params, results, errors)
+
+    response = AmzXmlStream(
+        products.GetCompetitivePricingForASIN(**{**params, 'ASINList': missing}, coalesce=coalesce, use_cache=use_cache)
     )
 
-    results, errors = {}, {}
-    for result_tag in response.tree.iterdescendants('GetCompetitivePricingForASINResult'):
+    fetched = {}
+    for result_tag in response.iter_elements('GetCompetitivePricingForASINResult'):
         price = {}
         sku = result_tag.attrib.get('ASIN')
+        if sku not in missing:
+            continue
 
         # Check that the request succeeded.
         if result_tag.attrib.get('status') != 'Success':
@@ -137,7 +184,7 @@ def GetCompetitivePricingForASIN(asin=None, **kwargs):
             errors[sku] = f'{code}: {message}'
             continue
 
-        for price_tag in result_tag.iterdescendants('CompetitivePrice'):
+        for price_tag in result_tag.iterdescendants('{*}CompetitivePrice'):
             if price_tag.attrib.get('condition') != 'New':
                 continue
 
@@ -145,15 +192,18 @@ def GetCompetitivePricingForASIN(asin=None, **kwargs):
             price['shipping'] = response.xpath_get('.//Shipping/Amount', price_tag, _type=float)
             price['landed_price'] = response.xpath_get('.//LandedPrice/Amount', price_tag, _type=float)
 
-        for count_tag in result_tag.iterdescendants('OfferListingCount'):
+        for count_tag in result_tag.iterdescendants('{*}OfferListingCount'):
             if count_tag.attrib.get('condition') == 'New':
                 price['offers'] = count_tag.text
         else:
             if 'offers' not in price:
                 price['offers'] = 0
 
-        results[sku] = price
-
-    return format_parsed_response('GetCompetitivePricingForASIN', params, results, errors)
+        fetched[sku] = price
 
+    # A stale response is already being refreshed in the background, so it is only cached for as long as it is fresh
+    fresh_for = products.GetCompetitivePricingForASIN.fresh_for
+    entity_cache.set_many('GetCompetitivePricingForASIN', market_id, fetched, fresh_for)
+    results.update(fetched)
 
+    return format_parsed_response('GetCompetitivePricingForASIN', params, results, errors)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+
+# The worker's modules are imported from the worker directory, like the worker itself does. Nothing in the tests
+# connects to these; they only have to be set for the modules to import.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379')
+os.environ.setdefault('MONGODB_URI', 'mongodb://localhost:27017/broccoli')
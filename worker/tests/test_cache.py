@@ -0,0 +1,32 @@
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from mws.cache import LRUCache, ResponseCache
+
+
+########################################################################################################################
+
+
+def test_stale_local_copy_picks_up_refreshed_value():
+    redis = fakeredis.FakeRedis()
+    first, second = ResponseCache(redis, LRUCache()), ResponseCache(redis, LRUCache())
+
+    # The first process caches a value that is already stale, i.e., within stale_ttl of expiring
+    first.set('key', 'old', 60)
+    assert first.get_entry('key', stale_ttl=60)[1] == 'old'
+
+    # Once another process refreshes it, the first one sees the new value instead of its local copy
+    second.set('key', 'new', 120)
+    expires_at, value = first.get_entry('key', stale_ttl=60)
+    assert value == 'new'
+    assert first.local.get('key') == 'new'
+
+
+def test_fresh_local_copy_is_used():
+    redis = fakeredis.FakeRedis()
+    cache = ResponseCache(redis, LRUCache())
+
+    cache.set('key', 'value', 120)
+    redis.delete('key')
+    assert cache.get_entry('key', stale_ttl=60)[1] == 'value'
@@ -0,0 +1,47 @@
+from bson import ObjectId
+
+from ops.products import merge_listing_data, listing_result, needs_fees
+
+
+########################################################################################################################
+
+
+def pricing(results):
+    return {'action': 'GetCompetitivePricingForASIN', 'params': {}, 'results': results}
+
+
+def test_merge_offers_only_pricing():
+    # Listings without a New competitive price only come back with an offer count
+    product = merge_listing_data({'sku': 'B000000000', 'price': 20.0}, [pricing({'B000000000': {'offers': '3'}})])
+    assert product == {'sku': 'B000000000', 'price': 20.0, 'offers': '3'}
+
+
+def test_merge_pricing_without_landed_price():
+    result = {'B000000000': {'listing_price': 20.0, 'shipping': 5.0, 'offers': '1'}}
+    assert merge_listing_data({'sku': 'B000000000'}, [pricing(result)])['price'] == 25.0
+
+
+########################################################################################################################
+
+
+def test_fees_estimated_when_price_changes():
+    product = {'_id': ObjectId(), 'price': 25.0, 'market_fees': 4.0}
+    assert needs_fees(listing_result(product, {'price': 25.0}))
+
+
+def test_fees_estimated_when_price_unchanged_and_fees_missing():
+    product = {'_id': ObjectId(), 'sku': 'B000000000', 'price': 25.0, 'title': 'Thing'}
+    listing = listing_result(product, {'title': 'Thing'})
+
+    assert 'market_fees' in listing['missing']
+    assert needs_fees(listing)
+
+
+def test_fees_skipped_when_price_unchanged_and_fees_present():
+    product = {'_id': ObjectId(), 'price': 25.0, 'market_fees': 4.0}
+    assert not needs_fees(listing_result(product, {}))
+
+
+def test_fees_skipped_without_a_price():
+    product = {'_id': ObjectId(), 'price': None}
+    assert not needs_fees(listing_result(product, {}))
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from bson import ObjectId
+
+from ops.products import calculate_opportunity
+from ops.repricing import load_columns, calculate_metrics
+
+
+########################################################################################################################
+
+
+def opportunity(market=None, supplier=None, supplier_vendor=None):
+    """Return an opportunity, joined like opportunity_pipeline() and join_vendors() do, with some fields overridden."""
+    return {
+        '_id': ObjectId(),
+        'market_product': {'vendor': ObjectId(), 'price': 30.0, 'quantity': {'numeric': 1}, 'market_fees': 5.0,
+                           **(market or {})},
+        'supplier_product': {'vendor': ObjectId(), 'price': 24.0, 'quantity': {'numeric': 2}, **(supplier or {})},
+        'market_vendor': {'name': 'Amazon'},
+        'supplier_vendor': {'name': 'Supplier', 'ship_rate': 0.1, **(supplier_vendor or {})}
+    }
+
+
+cases = {
+    'complete': opportunity(),
+    'listing ship rate': opportunity(supplier={'ship_rate': 0.2}),
+    'no ship rate anywhere': opportunity(supplier_vendor={'ship_rate': 0}),
+    'integer prices': opportunity(market={'price': 30}, supplier={'price': 24}),
+    'numeric string price': opportunity(market={'price': '30.0'}),
+    'numeric string quantity': opportunity(supplier={'quantity': {'numeric': '2'}}),
+    'numeric string ship rate': opportunity(supplier={'ship_rate': '0.2'}),
+    'null ship rate': opportunity(supplier={'ship_rate': None}),
+    'null vendor ship rate': opportunity(supplier_vendor={'ship_rate': None}),
+    'missing fees': opportunity(market={'market_fees': None}),
+    'zero market price': opportunity(market={'price': 0}),
+    'missing vendor': {k: v for k, v in opportunity().items() if k != 'supplier_vendor'}
+}
+del cases['no ship rate anywhere']['supplier_vendor']['ship_rate']
+
+
+@pytest.mark.parametrize('name', cases)
+def test_vectorized_metrics_match_scalar(name):
+    opp = cases[name]
+    ids, data = load_columns([opp])
+    metrics, valid = calculate_metrics(data)
+
+    try:
+        expected = calculate_opportunity(opp)
+    except ValueError:
+        assert not valid[0]
+    else:
+        assert valid[0]
+        for metric, value in expected.items():
+            assert np.isclose(metrics[metric][0], value)
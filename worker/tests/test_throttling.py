@@ -0,0 +1,62 @@
+import pytest
+from celery.exceptions import Retry
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from mws.limiter import QuotaLimiter
+from mws.products import GetCompetitivePricingForASIN
+from worker import app
+
+
+########################################################################################################################
+
+
+@app.task(bind=True)
+def reserve_quota(self):
+    """Reserve quota in-process, like the parsed.* tasks do when they call the mws.* tasks."""
+    GetCompetitivePricingForASIN.wait_for_quota()
+
+
+@pytest.fixture
+def requeued(monkeypatch):
+    """Run reserve_quota like a worker would, and return the countdowns it was requeued with."""
+    server = fakeredis.FakeRedis()
+    monkeypatch.setattr(GetCompetitivePricingForASIN, 'redis', server)
+    monkeypatch.setattr(GetCompetitivePricingForASIN, 'limiter', QuotaLimiter(server))
+    monkeypatch.setattr(GetCompetitivePricingForASIN, 'throttle_mode', 'reschedule')
+    monkeypatch.setattr(GetCompetitivePricingForASIN, '_limits', {'quota_max': 1, 'restore_rate': 60})
+
+    countdowns = []
+
+    def retry(countdown, max_retries):
+        countdowns.append(countdown)
+        return Retry(when=countdown)
+
+    monkeypatch.setattr(reserve_quota, 'retry', retry)
+    return countdowns
+
+
+def test_throttled_retry_reuses_its_reservation(requeued):
+    usage_key = GetCompetitivePricingForASIN.usage_key
+    redis = GetCompetitivePricingForASIN.redis
+
+    # The first call uses up the quota, so the next one is throttled for a full restore period
+    reserve_quota.apply(task_id='first')
+    reserve_quota.apply(task_id='second')
+    assert len(requeued) == 1 and requeued[0] > 59
+    assert redis.exists(f'{usage_key}_reservation_second')
+    quota_level = float(redis.hget(usage_key, 'quota_level'))
+
+    # The requeued task waits for the rest of its original slot, instead of reserving another one behind it
+    reserve_quota.apply(task_id='second')
+    assert len(requeued) == 2 and requeued[1] <= requeued[0]
+    assert float(redis.hget(usage_key, 'quota_level')) == quota_level
+
+
+def test_usage_outlives_the_reservation_backlog():
+    limiter = QuotaLimiter(fakeredis.FakeRedis())
+    for _ in range(5):
+        limiter.reserve('usage', quota_max=1, restore_rate=60, expires=10)
+
+    # Forgetting the usage before the backlog is restored would hand out a full burst on top of the queued calls
+    assert limiter.redis.ttl('usage') >= 5 * 60 - 1
@@ -1,5 +1,37 @@
 import os
-from celery import Celery
+from celery import Celery, Task
+
+import serializers
+
+
+########################################################################################################################
+
+
+class Throttled(Exception):
+    """Raised by a task that has reserved API quota, but would have to wait before using it."""
+
+    def __init__(self, countdown):
+        super().__init__(f'Throttled for {countdown:.2f} seconds')
+        self.countdown = countdown
+
+
+class BroccoliTask(Task):
+    """Base class for all tasks. When a task executed by a worker raises Throttled, either itself or from an API call
+    it makes in-process, it is requeued with a countdown instead of holding on to the worker while it waits."""
+
+    def __call__(self, *args, **kwargs):
+        called_directly = self.request.called_directly
+        try:
+            if called_directly:
+                return super().__call__(*args, **kwargs)
+            # The worker has already pushed the task's request. Task.__call__ would push another one without the task
+            # ID, and the body needs the ID to find what it saved before being requeued (e.g., its quota reservation).
+            return self.run(*args, **kwargs)
+        except Throttled as e:
+            if called_directly:
+                raise
+            # Waiting for quota is not a failure, so it shouldn't use up the task's retries
+            raise self.retry(countdown=e.countdown, max_retries=self.request.retries + 1)
 
 
 ########################################################################################################################
@@ -9,15 +41,29 @@ app = Celery(
     'worker',
     broker=os.environ.get('REDIS_URL', 'redis://'),
     backend=os.environ.get('REDIS_URL', 'redis://'),
+    task_cls=BroccoliTask,
     include=[
         'mws.products',
         'mws.product_adv',
         'parsed.products',
         'parsed.product_adv',
         'ops.spiders',
-        'ops.products'
+        'ops.products',
+        'ops.repricing',
+        'ops.vendors',
+        'ops.indexes'
     ]
 )
+serializers.configure(app)
+
+recompute_interval = float(os.environ.get('OPS_RECOMPUTE_INTERVAL', 60))
+app.conf.beat_schedule = {
+    'recompute-dirty-opportunities': {
+        'task': 'ops.products.recompute_dirty_opportunities',
+        'schedule': recompute_interval,
+        'options': {'expires': recompute_interval}
+    }
+}
 
 
 ########################################################################################################################